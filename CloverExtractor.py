@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 # 0.0.0
 from Scripts import *
-import os, tempfile, datetime, shutil, time, plistlib, json, sys
+import os, tempfile, datetime, shutil, time, plistlib, json, sys, atexit
 
 class CloverExtractor:
     def __init__(self, **kwargs):
@@ -10,6 +10,8 @@ class CloverExtractor:
         self.d  = disk.Disk()
         self.dl = downloader.Downloader()
         self.re = reveal.Reveal()
+        self.ex = extractor.Extractor()
+        self.ei = efiinfo.EfiInfo()
         # Keep our source local
         self.c_source = os.path.join(os.path.dirname(os.path.realpath(__file__)), self.script_folder, "src")
         # Make sure the src folder exists
@@ -34,6 +36,18 @@ class CloverExtractor:
             self.settings = {
                 # Default settings here
                 "select_efi_drivers" : True,
+                "extract_workers" : 0, # 0 = one per core
+                "cache_extracted" : True,
+                "cache_budget" : 268435456, # 256 MiB
+                "extract_to_memory" : False,
+                "memory_budget" : 67108864, # 64 MiB
+                "skip_unchanged" : True, # Leave drivers that match the package alone
+                "copy_workers" : 4, # Concurrent copies per disk
+                "plan_write_rate" : 10485760, # Assumed write speed for --plan estimates (10 MiB/s)
+                "archive_keep" : 5, # Old CLOVERX64/BOOTX64 versions to hold onto - 0 for no limit
+                "archive_budget" : 0, # Bytes they can take up on the EFI - 0 for no limit
+                "free_space_margin" : 1048576, # Room to leave free on the EFI after staging (1 MiB)
+                "verify_install" : False, # Re-read everything we wrote and check its hash
                 "debug" : False
             }
         self.c.debug = self.settings.get("debug",False)
@@ -151,11 +165,16 @@ class CloverExtractor:
         if not quiet:
             print(message)
 
-    def mount_and_copy(self, disk, package, archive = False, quiet = False):
-        # Mounts the passed disk and extracts the package target to the destination
+    def mount_and_copy(self, disk, package, archive = False, quiet = False, plan_only = False):
+        # Mounts the passed disk and extracts the package target to the destination - or
+        # just lays out what would happen with plan_only
+        with self.r.span("mount_and_copy", disk=disk, package=os.path.basename(package), plan_only=plan_only):
+            return self._mount_and_copy(disk, package, archive, quiet, plan_only)
+
+    def _mount_and_copy(self, disk, package, archive = False, quiet = False, plan_only = False):
         self.d.update()
         if not quiet:
-            self.u.head("Extracting {} to {}...".format(os.path.basename(package), disk))
+            self.u.head("{} {} to {}...".format("Planning" if plan_only else "Extracting", os.path.basename(package), disk))
             print("")
         if self.d.is_mounted(disk):
             mounted = True
@@ -172,9 +191,13 @@ class CloverExtractor:
             print(" ")
         # Create a temp folder
         temp = tempfile.mkdtemp()
-        results = self.extract_clover(package, temp)
+        results = self.get_extracted(package, temp)
+        if not results:
+            print("Error extracting {}!".format(os.path.basename(package)))
+            self.cleanup(temp, disk, mounted, quiet)
+            return False
         efi_drivers,binaries = results
-        clover = next((efi_drivers[x]["path"] for x in efi_drivers if os.path.basename(x.lower()) == "cloverx64.efi"), None)
+        clover = next((efi_drivers[x] for x in efi_drivers if os.path.basename(x.lower()) == "cloverx64.efi"), None)
         print(" ")
         if not clover:
             print("Error locating CLOVERX64.efi in {}!".format(os.path.basename(package)))
@@ -185,137 +208,314 @@ class CloverExtractor:
             print("EFI at {} not mounted!".format(disk))
             self.cleanup(temp, disk, mounted, quiet)
             return False
-
-        # Copy Clover
+        if plan_only:
+            if os.path.exists(transaction.Transaction(efi_mount).journal):
+                print("An interrupted install on {} will be rolled back first.".format(disk))
+            self.print_plan(self.plan_install(clover, efi_drivers, binaries, efi_mount, archive), efi_mount, disk)
+            self.cleanup(temp, disk, mounted, quiet)
+            return True
+        # Finish up or undo anything a previous run left half done on this EFI
         try:
-            c_out = self.copy_clover(clover, efi_mount, archive, quiet)
+            state = transaction.recover(efi_mount)
         except Exception as e:
             print(str(e))
-            c_out = False    
-        if self.settings.get("select_efi_drivers", True):
-            # Check our clover version and ensure the EFI is setup correctly
-            t_clover_v = self.get_clover_version(clover)
-            self.ensure_for_version(efi_mount, t_clover_v)
-            # Copy EFI Drivers
-            try:
-                self.copy_efi_drivers(efi_drivers, efi_mount, quiet)
-            except Exception as e:
-                print(str(e))
-
-        # Check for local binaries
-        if len(binaries):
-            bin_path = os.path.join("/","usr","local","bin")
-            to_copy = []
-            for x in binaries:
-                if os.path.exists(os.path.join(bin_path,x)):
-                    to_copy.append(x)
-            if not len(to_copy):
-                print("\nNo clover-related binaries found in /usr/local/bin - nothing to update.")
-            else:
-                print("\nFound {} clover-related binar{} in /usr/local/bin - replacing...\n".format(len(to_copy), "y" if len(to_copy) == 1 else "ies"))
-                # Replace the binaries
-                for f in to_copy:
-                    print(" Replacing {}...".format(f))
-                    # os.remove(os.path.join(bin_path,f))
-                    out = self.r.run({"args":["rm","-f",os.path.join(bin_path,f)],"sudo":True})
-                    if out[2] != 0:
-                        print(out[1])
-                        continue
-                    # shutil.copy(binaries[f]["path"], os.path.join(bin_path,f))
-                    out = self.r.run({"args":["cp",binaries[f]["path"],os.path.join(bin_path,f)],"sudo":True})
-                    if out[2] != 0:
-                        print(out[1])
-                        continue
+            self.cleanup(temp, disk, mounted, quiet)
+            return False
+        if state == "committed":
+            self.qprint("Cleaned up after a previous install on {}...".format(disk), quiet)
+        elif state:
+            print("Rolled back an interrupted install on {}...".format(disk))
+
+        plan = self.plan_install(clover, efi_drivers, binaries, efi_mount, archive)
+        # Make sure it all fits before we touch anything
+        check = self.preflight(plan, efi_mount)
+        if check["short"]:
+            # See if pruning old archives gets us there
+            plan = self.plan_install(clover, efi_drivers, binaries, efi_mount, archive, check["short"])
+            check = self.preflight(plan, efi_mount)
+            if check["short"]:
+                print("Not enough space on {} - {:,} more bytes are needed!".format(disk, check["short"]))
+                self.print_usage(efi_mount)
+                self.cleanup(temp, disk, mounted, quiet)
+                return False
+            print("Low on space - pruning old archives to make room...")
+        c_out = self.run_plan(plan, efi_mount, disk, quiet)
 
         # Clean up
         self.cleanup(temp, disk, mounted, quiet)
         return c_out
 
-    def copy_clover(self, clover, efi_mount, archive, quiet):
+    def run_plan(self, plan, efi_mount, disk, quiet = False):
+        # Carries out a plan from plan_install.  Everything on the EFI is staged in one
+        # transaction with the writes batched through the copy engine, then swapped in.
+        out = plan["ok"]
+        # Anything pruned to make room has to go before we start staging
+        for op in plan["clover"]:
+            if op["op"] == "remove" and op.get("early"):
+                self.print_op(op, quiet)
+                try:
+                    os.remove(op["target"])
+                except Exception as e:
+                    print(str(e))
+                self.ei.forget(op["target"])
+        tx = transaction.Transaction(efi_mount)
+        # The commit flushes everything - no need for the copier to as well
+        cp = copier.Copier(workers=self.settings.get("copy_workers", 4), sync=False)
+        try:
+            for op in plan["clover"]:
+                if op["op"] == "remove" and op.get("early"):
+                    continue
+                self.print_op(op, quiet)
+                if op["op"] == "move":
+                    self.move_file(op["source"], op["target"], tx)
+                elif op["op"] == "remove":
+                    tx.remove(op["target"])
+                    self.ei.forget(op["target"])
+                elif op["op"] == "index":
+                    tx.stage(op["target"], lambda path, data=op["data"]: self.write_entry({"data":data.encode("utf-8")}, path))
+                elif op["op"] == "write":
+                    self.queue_entry(cp, op["entry"], op["target"], tx)["group"] = "clover"
+            # Get the folders in place before we queue up anything that lands in them
+            self.run_migration(plan["layout"], tx)
+            for op in plan["drivers"]:
+                self.print_op(op, quiet)
+                if op["op"] == "write":
+                    self.queue_entry(cp, op["entry"], op["target"], tx)["group"] = "drivers"
+            writes = cp.run()
+            failed = [x for x in writes if x["error"]]
+            for op in failed:
+                print(" Failed to write {}: {}".format(os.path.basename(op["name"]), op["error"]))
+            drivers = [x for x in writes if x["group"] == "drivers" and not x["error"]]
+            unchanged = len([x for x in plan["drivers"] if x["op"] == "skip"])
+            if drivers or unchanged:
+                print("\nReplaced {} driver{}, {} unchanged - {:,} bytes written.".format(len(drivers), "" if len(drivers) == 1 else "s", unchanged, sum(x["bytes"] for x in drivers)))
+            if writes:
+                self.qprint(cp.summary(), quiet)
+            if failed:
+                # Don't commit a half updated EFI
+                raise OSError("Failed to write {} file{}".format(len(failed), "" if len(failed) == 1 else "s"))
+            self.qprint("\nCommitting changes to {}...".format(disk), quiet)
+            tx.commit()
+        except Exception as e:
+            print(str(e))
+            errors = tx.rollback() if tx.state == "staging" else []
+            print("Failed to update {} - {}.".format(disk, "rollback failed: " + ", ".join(errors) if errors else "no changes were made"))
+            out = False
+        # Binaries live outside the EFI and likely need root - swap them all in with a
+        # single sudo
+        pairs = []
+        for op in plan["binaries"]:
+            self.print_op(op, quiet)
+            if op["op"] == "binary":
+                pairs.append((op["entry"]["path"], op["target"]))
+        replaced = []
+        for target,error in privileged.Privileged(runner=self.r).replace(pairs):
+            if error:
+                print(" Failed to replace {}: {}".format(os.path.basename(target), error))
+            else:
+                replaced.append(target)
+        if self.settings.get("verify_install", False):
+            # Make sure what landed is what we extracted
+            items = []
+            if tx.state == "committed":
+                items.extend((x["target"], self.get_entry_hash(x["entry"])) for x in plan["clover"] + plan["drivers"] if x["op"] == "write")
+            items.extend((x["target"], self.get_entry_hash(x["entry"])) for x in plan["binaries"] if x["op"] == "binary" and x["target"] in replaced)
+            if not self.verify_install(items, quiet):
+                out = False
+        return out
+
+    def verify_install(self, items, quiet = False):
+        # Re-reads the passed (path, expected hash) tuples and reports any that don't
+        # match - returns True if they all do
+        if not items:
+            return True
+        self.qprint("\nVerifying {} file{}...".format(len(items), "" if len(items) == 1 else "s"), quiet)
+        results,elapsed = verify.Verifier(workers=self.settings.get("copy_workers", 4)).verify(items)
+        bad = [x for x in results if not x["ok"]]
+        for x in bad:
+            print(" {} failed verification: {}".format(x["path"], x["error"] or "expected {}, got {}".format(x["expected"][:16], x["actual"][:16])))
+        total = sum(x["size"] for x in results)
+        if bad:
+            print("{} of {} file{} failed verification!".format(len(bad), len(results), "" if len(results) == 1 else "s"))
+        else:
+            self.qprint("Verified {} file{} ({:,} bytes) in {:.2f}s - all match.".format(len(results), "" if len(results) == 1 else "s", total, elapsed), quiet)
+        return not bad
+
+    def print_op(self, op, quiet = False):
+        if op.get("message") and not (quiet and op.get("verbose")):
+            print(op["message"])
+
+    def print_plan(self, plan, efi_mount, disk):
+        # Lays out what run_plan would do and roughly what it'd cost
+        rate   = self.settings.get("plan_write_rate", 10485760)
+        counts = {}
+        efi_bytes = bin_bytes = 0
+        print("Install plan for {}:".format(disk))
+        for group in ("clover", "layout", "drivers", "binaries"):
+            for op in plan[group]:
+                if op["op"] == "note":
+                    self.print_op(op)
+                    continue
+                if op["op"] in ("mkdir", "finish"):
+                    # Bookkeeping - nothing worth showing
+                    continue
+                counts[op["op"]] = counts.get(op["op"], 0) + 1
+                written = op["bytes"] if op["op"] in ("write", "copy", "binary", "index") else 0
+                if group == "binaries":
+                    bin_bytes += written
+                else:
+                    efi_bytes += written
+                print("   {:<7} {:>12} {}".format(
+                    op["op"],
+                    "{:,}".format(written) if written else "-",
+                    op["target"] if group == "binaries" else os.path.relpath(op["target"], efi_mount)
+                ))
+        total = sum(counts.values())
+        print("\n{} operation{}{}".format(total, "" if total == 1 else "s", "" if not total else " - " + ", ".join("{} {}".format(counts[x], x) for x in sorted(counts))))
+        print("EFI writes: {:,} bytes, /usr/local/bin writes: {:,} bytes".format(efi_bytes, bin_bytes))
+        print("Estimated time: ~{:.1f}s at {:.1f} MB/s".format((efi_bytes + bin_bytes) / float(rate), rate / 1048576.0))
+        check = self.preflight(plan, efi_mount)
+        print("EFI space: {:,} bytes free, {:,} needed while staging, {:+,} once done".format(check["free"], check["peak"], check["net"]))
+        if check["short"]:
+            print("Not enough space on {} - {:,} more bytes are needed!  Old archives would be pruned if that's enough.".format(disk, check["short"]))
+            self.print_usage(efi_mount)
+        if not plan["ok"]:
+            print("CLOVERX64.efi was not found on {} - check that this is the right EFI.".format(disk))
+
+    def preflight(self, plan, efi_mount):
+        # Works out how much room the plan needs on the EFI.  New files are staged next to
+        # the old ones until the commit, so at its peak we need every byte we write - less
+        # anything pruned up front.  Returns a dict of the free, peak, net, and short bytes.
+        free,block = space.get_free(efi_mount)
+        peak = net = 0
+        moved = set()
+        for group in ("clover", "layout", "drivers"):
+            for op in plan[group]:
+                if op["op"] == "move":
+                    moved.add(op["source"])
+                elif op["op"] in ("write", "index", "copy"):
+                    size = space.round_up(op["bytes"], block)
+                    peak += size
+                    net  += size
+                    current = self.get_planned_path(op["target"], plan["layout"])
+                    if os.path.isfile(current) and not current in moved:
+                        # Replaces what's there
+                        net -= space.round_up(os.path.getsize(current), block)
+                elif op["op"] == "remove":
+                    freed = space.round_up(op.get("freed", 0), block)
+                    net -= freed
+                    if op.get("early"):
+                        peak -= freed
+        short = peak + self.settings.get("free_space_margin", 1048576) - free
+        return {"free":free, "peak":peak, "net":net, "short":max(0, short)}
+
+    def print_usage(self, efi_mount):
+        # Shows what's taking up room in EFI/CLOVER
+        if not os.path.isdir(os.path.join(efi_mount, "EFI", "CLOVER")):
+            return
+        print("")
+        print("\n".join(space.format_usage(efi_mount)))
+
+    def plan_note(self, message, verbose = False):
+        return {"op":"note", "target":None, "bytes":0, "message":message, "verbose":verbose}
+
+    def get_archive_store(self, efi_mount, retention = True):
+        # Without retention nothing gets pruned unless we're short on space
+        keep   = self.settings.get("archive_keep", 5) if retention else 0
+        budget = self.settings.get("archive_budget", 0) if retention else 0
+        store  = archive.ArchiveStore(efi_mount, keep=keep, budget=budget, hasher=self.ei.get_hash)
+        store.load()
+        return store
+
+    def plan_install(self, clover, efi_drivers, binaries, efi_mount, archive = False, reserve = 0):
+        # Works out everything an install would do without touching anything.  Returns a
+        # dict with lists of ops for each step - clover, layout, drivers, and binaries - in
+        # the order they'd run, and whether CLOVERX64.efi was already there.  Old archives
+        # are pruned to free up reserve bytes if passed.
+        plan = {"layout":[], "drivers":[]}
+        plan["ok"],plan["clover"] = self.plan_clover(clover, efi_mount, archive, reserve)
+        if self.settings.get("select_efi_drivers", True):
+            # Check our clover version and ensure the EFI is setup correctly
+            plan["layout"] = self.ensure_for_version(efi_mount, self.get_entry_version(clover), archive, dry_run=True)
+            plan["drivers"] = self.plan_efi_drivers(efi_drivers, efi_mount, plan["layout"])
+        plan["binaries"] = self.plan_binaries(binaries)
+        return plan
+
+    def plan_clover(self, clover, efi_mount, archive, reserve = 0):
+        # Returns a tuple of (CLOVERX64.efi exists, ops)
         c_path = os.path.join(efi_mount, "EFI", "CLOVER")
         b_path = os.path.join(efi_mount, "EFI", "BOOT")
         
         out = True
+        ops = []
 
-        t_clover_v = self.get_clover_version(clover)
+        t_clover_v = self.get_entry_version(clover)
         if not t_clover_v:
             t_clover_v = "Unknown"
+        size = self.get_entry_size(clover)
         
         # Copy CLOVERX64.efi to the CLOVER and BOOT folders if they exist
         got_clover = os.path.exists(os.path.join(c_path, "CLOVERX64.efi"))
         got_boot   = os.path.exists(os.path.join(b_path, "BOOTX64.efi"))
         if not got_clover:
-            print("CLOVERX64.efi does not exist!")
+            ops.append(self.plan_note("CLOVERX64.efi does not exist!"))
             out = False
         # Check the got_clover and got_boot versions
         got_clover_v = self.get_clover_version(os.path.join(c_path, "CLOVERX64.efi"))
         if not got_clover_v:
             got_clover_v = "Unknown"
-        self.qprint("     Found CLOVERX64.efi version: {}".format(got_clover_v), quiet)
+        ops.append(self.plan_note("     Found CLOVERX64.efi version: {}".format(got_clover_v), True))
         got_boot_v = None
         if got_boot:
             got_boot_v = self.get_clover_version(os.path.join(b_path, "BOOTX64.efi"))
             if not got_boot_v:
-                self.qprint("   Unknown BOOTX64.efi version - bypassing in case it's not Clover...", quiet)
+                ops.append(self.plan_note("   Unknown BOOTX64.efi version - bypassing in case it's not Clover...", True))
             else:
-                self.qprint("     Found BOOTX64.efi version: {}".format(got_boot_v), quiet)
+                ops.append(self.plan_note("     Found BOOTX64.efi version: {}".format(got_boot_v), True))
         if archive:
-            # Rename the old version to its version number
-            try:
-                self.qprint("  Renaming CLOVERX64.efi to CLOVERX64_r{}.efi".format(got_clover_v), quiet)
-                old_path = os.path.join(c_path, "CLOVERX64.efi")
-                new_path = os.path.join(c_path, "CLOVERX64_r{}.efi".format(got_clover_v))
-                if os.path.exists(new_path):
-                    # Already exists, overwrite it
-                    self.qprint("CLOVERX64_r{}.efi already exists - removing...".format(got_clover_v), quiet)
-                    os.remove(new_path)
-                os.rename(
-                    os.path.join(c_path, "CLOVERX64.efi"),
-                    os.path.join(c_path, "CLOVERX64_r{}.efi".format(got_clover_v))    
-                )
-                if got_boot and got_boot_v:
-                    self.qprint("  Renaming BOOTX64.efi to BOOTX64_r{}.efi".format(got_boot_v), quiet)
-                    old_path = os.path.join(b_path, "BOOTX64.efi")
-                    new_path = os.path.join(b_path, "BOOTX64_r{}.efi".format(got_boot_v))
-                    if os.path.exists(new_path):
-                        # Already exists, overwrite it
-                        self.qprint("BOOTX64_r{}.efi already exists - removing...".format(got_boot_v), quiet)
-                        os.remove(new_path)
-                    os.rename(
-                        os.path.join(b_path, "BOOTX64.efi"),
-                        os.path.join(b_path, "BOOTX64_r{}.efi".format(got_boot_v))    
-                    )
-            except Exception as e:
-                print(str(e))
-                out = False
+            # Rename the old version to its version number - unless we've already got a copy
+            incoming = []
+            for name,path,version,check in (("CLOVERX64", c_path, got_clover_v, got_clover), ("BOOTX64", b_path, got_boot_v, got_boot and got_boot_v)):
+                if not check:
+                    continue
+                source = os.path.join(path, name+".efi")
+                incoming.append({
+                    "source" : source,
+                    "target" : os.path.join(path, "{}_r{}.efi".format(name, version)),
+                    "sha256" : self.ei.get_hash(source),
+                    "size" : os.path.getsize(source),
+                    "revision" : version
+                })
+            store = self.get_archive_store(efi_mount)
+            a_ops,entries = store.plan(incoming, reserve)
+            ops.extend(a_ops)
+            ops.append(store.index_op(entries))
         else:
-            # Remove the old versions first, then copy new versions
-            try:
-                self.qprint("  Removing CLOVERX64.efi version: {}...".format(got_clover_v), quiet)
-                os.remove(os.path.join(c_path, "CLOVERX64.efi"))
-                if got_boot and got_boot_v:
-                    self.qprint("  Removing BOOTX64.efi version: {}...".format(got_boot_v), quiet)
-                    os.remove(os.path.join(b_path, "BOOTX64.efi"))
-            except Exception as e:
-                print(str(e))
-                out = False
-        try:
-            self.qprint("   Copying CLOVERX64.efi version: {}...".format(t_clover_v), quiet)
-            shutil.copy(clover, os.path.join(c_path, "CLOVERX64.efi"))
+            if reserve:
+                # Not archiving - but any old archives can still go to make room
+                store = self.get_archive_store(efi_mount, False)
+                a_ops,entries = store.plan([], reserve)
+                if a_ops:
+                    ops.extend(a_ops)
+                    ops.append(store.index_op(entries))
+            # The new versions replace the old ones
+            if got_clover:
+                ops.append(self.plan_note("  Replacing CLOVERX64.efi version: {}...".format(got_clover_v), True))
             if got_boot and got_boot_v:
-                self.qprint("   Copying BOOTX64.efi version: {}...".format(t_clover_v), quiet)
-                shutil.copy(clover, os.path.join(b_path, "BOOTX64.efi"))
-        except Exception as e:
-            print(str(e))
-            out = False
-        return out
+                ops.append(self.plan_note("  Replacing BOOTX64.efi version: {}...".format(got_boot_v), True))
+        ops.append({"op":"write", "entry":clover, "target":os.path.join(c_path, "CLOVERX64.efi"), "bytes":size, "message":"   Copying CLOVERX64.efi version: {}...".format(t_clover_v), "verbose":True})
+        if got_boot and got_boot_v:
+            ops.append({"op":"write", "entry":clover, "target":os.path.join(b_path, "BOOTX64.efi"), "bytes":size, "message":"   Copying BOOTX64.efi version: {}...".format(t_clover_v), "verbose":True})
+        return (out, ops)
 
-    def ensure_for_version(self, efi_path, clover_version):
+    def ensure_for_version(self, efi_path, clover_version, archive = False, dry_run = False, tx = None):
+        # Makes sure the driver folders the passed Clover version expects are there -
+        # migrating them from the other layouts if need be.  Returns the plan.
         # 4983 added BiosDrivers and UEFIDrivers at the CLOVER dir
         try:
             clover_version = int(clover_version)
         except:
-            return # We don't know what Clover this is - just... deal with it...
+            return [] # We don't know what Clover this is - just... deal with it...
         if clover_version < 4983:
             # We need to ensure that we migrate drivers/UEFI or UEFIDrivers to drivers64UEFI
             # and drivers/BIOS or BiosDrivers to drivers64
@@ -352,71 +552,182 @@ class CloverExtractor:
                 os.path.join(efi_path,"EFI","CLOVER","BiosDrivers"),
                 os.path.join(efi_path,"EFI","CLOVER","drivers64")
             ]
-        # Verify that our targets exist
-        if not os.path.exists(targetUEFI):
-            # Iterate our sources and clone if they exist
-            for x in sourceUEFI:
-                if os.path.exists(x):
-                    # Create the target - and copy the contents
-                    os.makedirs(targetUEFI)
-                    for y in os.listdir(x):
-                        path = os.path.join(x,y)
-                        try:
-                            shutil.copy(path,targetUEFI)
-                        except Exception as e:
-                            print("Failed to copy {}: {}".format(y,e))
-                    # Assume we copied what was needed - bail
-                    break
-        if not os.path.exists(targetBIOS):
-            # Iterate our sources and clone if they exist
-            for x in sourceBIOS:
-                if os.path.exists(x):
-                    # Create the target - and copy the contents
-                    os.makedirs(targetBIOS)
-                    for y in os.listdir(x):
-                        path = os.path.join(x,y)
-                        try:
-                            shutil.copy(path,targetBIOS)
-                        except Exception as e:
-                            print("Failed to copy {}: {}".format(y,e))
-                    # Assume we copied what was needed - bail
-                    break
-        
+        # Work out what's needed to get our targets in place
+        plan = self.plan_migration(targetUEFI, sourceUEFI, not archive) + self.plan_migration(targetBIOS, sourceBIOS, not archive)
+        if dry_run:
+            return plan
+        self.run_migration(plan, tx)
+        return plan
 
-    def copy_efi_drivers(self, efi_list, efi_path, quiet):
+    def plan_migration(self, target, sources, move = False):
+        # Returns a list of ops to populate target from the first source folder that exists.
+        # Renames when we're allowed to move things, otherwise files are copied - skipping
+        # any an interrupted earlier migration already brought over.
+        marker = os.path.join(target, ".migrating")
+        if os.path.exists(target) and not os.path.exists(marker):
+            # Already set up
+            return []
+        source = next((x for x in sources if os.path.isdir(x)), None)
+        if not source:
+            return []
+        if move and not os.path.exists(target):
+            # Just rename the whole folder - nothing gets written
+            size = sum(os.path.getsize(os.path.join(source,x)) for x in os.listdir(source) if os.path.isfile(os.path.join(source,x)))
+            return [{"op":"rename", "source":source, "target":target, "bytes":size}]
+        plan = [{"op":"mkdir", "source":None, "target":target, "bytes":0}]
+        for x in sorted(os.listdir(source)):
+            path = os.path.join(source,x)
+            if not os.path.isfile(path):
+                continue
+            dest = os.path.join(target,x)
+            size = os.path.getsize(path)
+            if os.path.isfile(dest) and os.path.getsize(dest) == size:
+                # Made it over last time
+                continue
+            plan.append({"op":"move" if move else "copy", "source":path, "target":dest, "bytes":size})
+        plan.append({"op":"finish", "source":None, "target":target, "bytes":0})
+        return plan
+
+    def run_migration(self, plan, tx = None):
+        # Carries out a plan from plan_migration - renames are journaled in the transaction
+        # if we have one so a failed install can put the old layout back
+        cp = copier.Copier(workers=self.settings.get("copy_workers", 4))
+        for op in plan:
+            try:
+                if op["op"] == "rename":
+                    print("Moving {} to {}...".format(os.path.basename(op["source"]), os.path.basename(op["target"])))
+                    # drivers64UEFI -> drivers/UEFI needs drivers made first
+                    parent = os.path.dirname(op["target"])
+                    if tx is None:
+                        if not os.path.exists(parent):
+                            os.makedirs(parent)
+                        os.rename(op["source"], op["target"])
+                    else:
+                        tx.mkdir_now(parent)
+                        tx.move_now(op["source"], op["target"])
+                elif op["op"] == "mkdir":
+                    # Leave a marker so an interrupted migration picks up where it left off
+                    if not os.path.exists(op["target"]):
+                        os.makedirs(op["target"])
+                    open(os.path.join(op["target"], ".migrating"), "w").close()
+                elif op["op"] == "move":
+                    if tx is None:
+                        os.rename(op["source"], op["target"])
+                    else:
+                        tx.move_now(op["source"], op["target"])
+                elif op["op"] == "copy":
+                    cp.add(op["target"], writer=lambda target, source=op["source"]: self.link_or_copy(source, target))
+                elif op["op"] == "finish":
+                    failed = [x for x in cp.run() if x["error"]]
+                    for c in failed:
+                        print("Failed to copy {}: {}".format(os.path.basename(c["target"]),c["error"]))
+                    if not failed:
+                        # All there - we're done with this one
+                        os.remove(os.path.join(op["target"], ".migrating"))
+            except Exception as e:
+                print("Failed to migrate {}: {}".format(os.path.basename(op["source"] or op["target"]),e))
+
+    def link_or_copy(self, source, target):
+        # Hardlinks where the filesystem allows it (not FAT) - copies otherwise
+        if os.path.exists(target):
+            os.remove(target)
+        try:
+            os.link(source, target)
+        except (OSError, AttributeError):
+            shutil.copy(source, target)
+        return os.path.getsize(target)
+
+    def plan_efi_drivers(self, efi_list, efi_path, layout = []):
+        # Returns the ops to update the drivers already on the EFI - as it'll look once the
+        # passed layout plan has run
+        # Only consider UEFI drivers - leave out applications (tools, CLOVERX64.efi, etc) but
+        # keep anything we can't parse in case it's a driver in disguise
+        drivers = {}
+        for x in efi_list:
+            pe = self.get_entry_pe(efi_list[x])
+            if pe and not pe["driver"]:
+                continue
+            drivers[x] = efi_list[x]
+        efi_list = drivers
+        # Map the normalized names once so each folder is a single pass
+        index = self.get_driver_index(efi_list)
+        skip = self.settings.get("skip_unchanged", True)
+        ops = []
         for d in ["drivers64", "drivers32", "drivers64UEFI", "drivers32UEFI", "drivers/UEFI", "drivers/BIOS"]:
             d64 = os.path.join(efi_path, "EFI", "CLOVER", d)
-            if not os.path.exists(d64):
+            installed = self.get_planned_listing(d64, layout)
+            if installed is None:
                 # Nothing to do here
                 continue
             # Get the defaults
-            installed = sorted([x for x in os.listdir(d64) if x.lower().endswith(".efi") and not x.startswith(".")])
-            to_copy = []
-            for x in installed:
-                for y in efi_list:
-                    # Replace if the values match with or without the "-64" suffix - but only replace once
-                    if x.lower().replace("-64","") == y.lower().replace("-64","") and not any(z for z in to_copy if z["find"] == x):
-                        # Add it
-                        to_copy.append({"find":x, "replace":y})
-                        break
-            # to_copy   = sorted([x for x in efi_list if installed_mapped.get(x.lower(), None)])
+            installed = sorted([x for x in installed if x.lower().endswith(".efi") and not x.startswith(".")])
+            # Replace if the values match with or without the "-64" suffix
+            to_copy = [{"find":x, "replace":index[self.get_driver_key(x)]} for x in installed if self.get_driver_key(x) in index]
 
             if not len(installed):
                 # Nothing to replace
                 continue
 
             if not len(to_copy):
-                print("\nFound 0 of {} efi driver{} in {} - skipping...\n".format(len(installed), "" if len(installed) == 1 else "s", d))
+                ops.append(self.plan_note("\nFound 0 of {} efi driver{} in {} - skipping...\n".format(len(installed), "" if len(installed) == 1 else "s", d)))
                 continue
 
-            print("\nFound {} of {} efi driver{} in {} - replacing...\n".format(len(to_copy), len(installed), "" if len(installed) == 1 else "s", d))
+            ops.append(self.plan_note("\nFound {} of {} efi driver{} in {} - replacing...\n".format(len(to_copy), len(installed), "" if len(installed) == 1 else "s", d)))
 
             for f in to_copy:
-                print(" Replacing {}...".format(f["find"]))
-                os.remove(os.path.join(d64, f["find"]))
-                shutil.copy(efi_list[f["replace"]]["path"], os.path.join(d64, f["find"]))
+                target = os.path.join(d64, f["find"])
+                entry  = efi_list[f["replace"]]
+                if skip and self.entry_matches(entry, self.get_planned_path(target, layout)):
+                    ops.append({"op":"skip", "target":target, "bytes":0, "message":" {} is unchanged - skipping...".format(f["find"])})
+                    continue
+                message = " Replacing {}...".format(f["find"])
                 if f["find"].lower() != f["replace"].lower():
-                    print("  - {} --> {}".format(f["replace"], f["find"]))
+                    message += "\n  - {} --> {}".format(f["replace"], f["find"])
+                ops.append({"op":"write", "entry":entry, "target":target, "bytes":self.get_entry_size(entry), "message":message})
+        return ops
+
+    def plan_binaries(self, binaries):
+        # Returns the ops to replace the clover-related binaries already in /usr/local/bin
+        ops = []
+        if not len(binaries):
+            return ops
+        bin_path = os.path.join("/","usr","local","bin")
+        to_copy = sorted([x for x in binaries if os.path.exists(os.path.join(bin_path,x))])
+        if not len(to_copy):
+            ops.append(self.plan_note("\nNo clover-related binaries found in /usr/local/bin - nothing to update."))
+            return ops
+        ops.append(self.plan_note("\nFound {} clover-related binar{} in /usr/local/bin - replacing...\n".format(len(to_copy), "y" if len(to_copy) == 1 else "ies")))
+        for f in to_copy:
+            ops.append({"op":"binary", "entry":binaries[f], "target":os.path.join(bin_path,f), "bytes":self.get_entry_size(binaries[f]), "message":" Replacing {}...".format(f)})
+        return ops
+
+    def get_planned_listing(self, folder, layout = []):
+        # Returns the names folder will hold once the layout plan has run - or None if
+        # it won't exist
+        for op in layout:
+            if op["op"] == "rename" and op["target"] == folder:
+                return sorted(os.listdir(op["source"]))
+            if op["op"] == "rename" and op["source"] == folder:
+                return None
+        names = set(os.listdir(folder)) if os.path.isdir(folder) else None
+        for op in layout:
+            if op["op"] == "mkdir" and op["target"] == folder and names is None:
+                names = set()
+            elif op["op"] in ("copy", "move") and names is not None:
+                if os.path.dirname(op["target"]) == folder:
+                    names.add(os.path.basename(op["target"]))
+                if op["op"] == "move" and os.path.dirname(op["source"]) == folder:
+                    names.discard(os.path.basename(op["source"]))
+        return None if names is None else sorted(names)
+
+    def get_planned_path(self, path, layout = []):
+        # Returns where the file that'll be at path once the layout plan has run is now
+        for op in layout:
+            if op["op"] == "rename" and path.startswith(op["target"] + os.sep):
+                return op["source"] + path[len(op["target"]):]
+            if op["op"] in ("copy", "move") and op["target"] == path:
+                return op["source"]
+        return path
 
     def cleanup(self, temp, disk, mount_status, quiet):
         shutil.rmtree(temp)
@@ -431,94 +742,102 @@ class CloverExtractor:
 
     def get_clover_version(self, f):
         # Attempts to get the clover version via binary string searching
-        #
-        # Hex for "Clover revision: "
-        if not f:
-            return None
-        vers_hex = "Clover revision: ".encode("utf-8")
-        vers_add = len(vers_hex)
-        with open(f, "rb") as f:
-            s = f.read()
-        location = s.find(vers_hex)
-        if location == -1:
+        return self.ei.get_clover_version(f)
+
+    def get_entry_version(self, entry):
+        # Gets the clover version from an extracted entry - whether it's on disk or in memory
+        if not entry:
             return None
-        location += vers_add
-        version = ""
-        while True:
-            try:
-                vnum = s[location:location+1].decode("utf-8")
-                numtest = int(vnum)
-                version += str(vnum)
-            except:
-                break
-            location += 1
-        if not len(version):
+        if "data" in entry:
+            return self.ei.get_version_from_bytes(entry["data"])
+        return self.get_clover_version(entry.get("path"))
+
+    def get_entry_pe(self, entry):
+        # Gets the PE info from an extracted entry - or None if it's not a PE image
+        if not entry:
             return None
-        return version
+        if "data" in entry:
+            return self.ei.parse_pe(entry["data"])
+        return self.ei.get_pe_info(entry.get("path"))
+
+    def get_entry_size(self, entry):
+        if "data" in entry:
+            return len(entry["data"])
+        if "size" in entry:
+            return entry["size"]
+        return os.path.getsize(entry["path"])
+
+    def get_entry_hash(self, entry):
+        # Returns the SHA-256 of an extracted entry - hashing it once and keeping the result
+        if not "sha256" in entry:
+            entry["sha256"] = hashing.hash_bytes(entry["data"]) if "data" in entry else self.ei.get_hash(entry["path"])
+        return entry["sha256"]
+
+    def entry_matches(self, entry, target):
+        # Checks if the file at target is identical to the entry - sizes first, then hashes
+        try:
+            if not os.path.isfile(target) or os.path.getsize(target) != self.get_entry_size(entry):
+                return False
+            return self.ei.get_hash(target) == self.get_entry_hash(entry)
+        except Exception:
+            return False
+
+    def write_entry(self, entry, target):
+        # Writes an extracted entry to the target path - straight from memory if we have it.
+        # Returns the number of bytes written.
+        self.ei.forget(target)
+        if "data" in entry:
+            with open(target, "wb") as f:
+                f.write(entry["data"])
+        else:
+            shutil.copy(entry["path"], target)
+        return self.get_entry_size(entry)
+
+    def get_driver_key(self, name):
+        # Drivers match case-insensitively with or without the "-64" suffix
+        return name.lower().replace("-64","")
+
+    def get_driver_index(self, efi_list):
+        # Returns a dict of normalized name : efi_list key - the first one wins
+        index = {}
+        for x in efi_list:
+            index.setdefault(self.get_driver_key(x), x)
+        return index
+
+    def queue_entry(self, cp, entry, target, tx = None):
+        # Queues an entry to be written over target by the passed copier - into the
+        # transaction's temp file if we have one.  Returns the copier op.
+        if tx is None:
+            if os.path.exists(target):
+                os.remove(target)
+            path = target
+        else:
+            path = tx.reserve(target)
+        self.ei.forget(target)
+        op = cp.add(path, writer=lambda p: self.write_entry(entry, p))
+        op["name"] = target
+        return op
+
+    def move_file(self, source, target, tx = None):
+        # Renames source to target, replacing it - deferred until commit with a transaction
+        if tx is None:
+            if os.path.exists(target):
+                os.remove(target)
+            os.rename(source, target)
+        else:
+            tx.move(source, target)
+        self.ei.forget(source)
+        self.ei.forget(target)
 
     def extract_clover(self, package, temp):
         # Extracts the passed clover package and returns the path to the CLOVERX64.efi
         # Returns None on failure
-        cwd = os.getcwd()
-        os.chdir(os.path.dirname(os.path.realpath(temp)))
-
-        out = self.r.run({"args":["/usr/sbin/pkgutil", "--expand", package, os.path.join(temp, "pkg")]})        
-        if out[2] != 0:
-            os.chdir(cwd)
-            print("pkgutil", out[1])
+        self.ex.workers = self.settings.get("extract_workers", 0)
+        memory = self.settings.get("memory_budget", 67108864) if self.settings.get("extract_to_memory", False) else 0
+        out = self.ex.extract(package, temp, self.settings.get("select_efi_drivers", True), memory)
+        if not out:
             return False
-
-        # Iterate all packages - and extract them all
-        c = os.getcwd()
-        e = os.path.join(c, "efi_drivers")
-        b = os.path.join(c, "binaries")
-        el = {} # The EFI driver list
-        bn = {} # The binary list
-        if not os.path.exists(e):
-            os.mkdir(e)
-        if not os.path.exists(b):
-            os.mkdir(b)
-        # Extract the Utils.pkg separately if we need to update the local
-        # /usr/local/bin
-        if os.path.exists(os.path.join(temp,"pkg","Utils.pkg")):
-            os.chdir(os.path.join(temp, "pkg", "Utils.pkg"))
-            print("Extracting Utils.pkg...")
-            try:
-                out = self.r.run({"args":["/usr/bin/tar", "xvf", "Payload"]})
-            except:
-                out = ("", "Failed to extract Utils.pkg", 1)
-            if out[2] != 0:
-                print(out[1])
-            else:
-                bin_path = os.path.join(temp,"pkg","Utils.pkg","usr","local","bin")
-                if os.path.exists(bin_path):
-                    # Gather the binaries
-                    for x in os.listdir(bin_path):
-                        os.rename(os.path.join(bin_path,x), os.path.join(b,x))
-                        bn[x] = { "path" : os.path.join(b,x), "show" : True, "selected" : True }
-        # Iterate the packages and extract the efi drivers
-        for pkg in [x for x in sorted(os.listdir(os.path.join(temp, "pkg"))) if x.lower().endswith(".pkg")]:
-            os.chdir(os.path.join(temp, "pkg", pkg))
-            if not pkg.lower() == "efifolder.pkg" and not self.settings.get("select_efi_drivers", True):
-                # We only want Clover
-                continue
-            print("Extracting {}...".format(pkg))
-            try:
-                out = self.r.run({"args":["/usr/bin/tar", "xvf", "Payload"]})
-            except:
-                out = ("", "Failed to extract {}".format(pkg), 1)
-            if out[2] != 0:
-                print(out[1])
-                continue
-            # Check for Clover
-            if os.path.exists(os.path.join(temp, "pkg", pkg, "EFI", "CLOVER", "CLOVERX64.efi")):
-                os.rename(os.path.join(temp, "pkg", pkg, "EFI", "CLOVER", "CLOVERX64.efi"), os.path.join(e, "CLOVERX64.efi"))
-                el["CLOVERX64.efi"] = { "path" : os.path.join(e, "CLOVERX64.efi"), "show" : False, "selected" : False }
-            # Check for other EFI drivers
-            for e_file in [x for x in os.listdir(os.path.join(temp, "pkg", pkg)) if x.lower().endswith(".efi")]:
-                os.rename(os.path.join(temp, "pkg", pkg, e_file), os.path.join(e, e_file))
-                el[e_file] = { "path" : os.path.join(e, e_file), "show" : True, "selected" : False }
-        os.chdir(c)
+        el,bn = out
 
         if not len(el):
             print("No efi drivers found!")
@@ -527,6 +846,36 @@ class CloverExtractor:
 
         return (el,bn)
 
+    def get_extracted(self, package, temp):
+        # Returns the (efi_drivers, binaries) for the passed package - served from the
+        # extraction cache if we've seen it before, otherwise extracted and cached
+        if not self.settings.get("cache_extracted", True):
+            return self.extract_clover(package, temp)
+        full  = self.settings.get("select_efi_drivers", True)
+        cache = pkgcache.PkgCache(os.path.join(self.check_clover_folder(), "Cache"), self.settings.get("cache_budget", 268435456))
+        try:
+            key = cache.get_key(package)
+            out = cache.get(key, full)
+        except Exception as e:
+            print("Extraction cache unavailable: {}".format(e))
+            return self.extract_clover(package, temp)
+        if out:
+            print("Using cached extraction of {}...".format(os.path.basename(package)))
+            return out
+        if self.settings.get("extract_to_memory", False):
+            # Keep it in memory - caching would just mean writing it out anyway
+            return self.extract_clover(package, temp)
+        stage = cache.new_stage()
+        out = self.extract_clover(package, stage)
+        if not out:
+            shutil.rmtree(stage, ignore_errors=True)
+            return out
+        try:
+            return cache.store(key, stage, out[0], out[1], full, package)
+        except Exception as e:
+            print("Failed to cache {}: {}".format(os.path.basename(package), e))
+            return out
+
     def get_clover_package(self):
         # Returns a clover package
         self.u.head("Clover Package")
@@ -638,7 +987,8 @@ class CloverExtractor:
         # Builds clover from soure - or attempts to...
         self.u.head("Building Clover")
         print("")
-        out = self.c.build_clover(pkg=pkg, iso=iso)
+        with self.r.span("build_clover", pkg=pkg, iso=iso):
+            out = self.c.build_clover(pkg=pkg, iso=iso)
         if pkg and not out.get("pkg",None):
             print("Looks like something went wrong building the Clover pkg...")
         if iso and not out.get("iso",None):
@@ -900,7 +1250,7 @@ class CloverExtractor:
                 print(" ")
                 self.u.grab("Press [enter] to return...")
 
-    def quiet_copy(self, args):
+    def quiet_copy(self, args, plan_only = False):
         # Iterate through the args
         arg_pairs = zip(*[iter(args)]*2)
         built = None
@@ -921,12 +1271,72 @@ class CloverExtractor:
                             # We haven't gathered info on it yet
                             latest = self.get_dl_info()
                         pkg = self.download_clover(latest, True)
-                    self.mount_and_copy(self.d.get_efi(pair[1]), pkg, False, True)
+                    self.mount_and_copy(self.d.get_efi(pair[1]), pkg, False, True, plan_only)
                 except Exception as e:
                     print(str(e))
 
 if __name__ == '__main__':
-    c = CloverExtractor()
+    if len(sys.argv) > 2 and sys.argv[1].lower() == "index":
+        # CloverExtractor.command index /path/to/clover.pkg [/path/to/manifest.json]
+        # Doesn't need anything macOS specific - so skip the full setup
+        try:
+            manifest = json.dumps(extractor.Extractor().index(sys.argv[2]), indent=2)
+        except Exception as e:
+            print("Failed to index {}: {}".format(sys.argv[2], e))
+            exit(1)
+        if len(sys.argv) > 3:
+            with open(sys.argv[3], "w") as f:
+                f.write(manifest)
+        else:
+            print(manifest)
+        exit(0)
+    if len(sys.argv) > 2 and sys.argv[1].lower() == "scan":
+        # CloverExtractor.command scan /path/to/EFI [/other/path ...]
+        root = os.path.commonprefix([os.path.abspath(x) for x in sys.argv[2:]])
+        results = efiinfo.EfiInfo().scan(sys.argv[2:])
+        if not results:
+            print("No .efi files found.")
+            exit(0)
+        print("{:<10} {:<22} {:<16} {}".format("Revision", "Type", "SHA-256", "Path"))
+        for r in results:
+            path = os.path.relpath(r["path"], root) if os.path.isdir(root) else r["path"]
+            if r.get("error"):
+                print("{:<10} {:<22} {:<16} {}".format("Error", r["error"][:22], "", path))
+                continue
+            print("{:<10} {:<22} {:<16} {}".format(r["revision"] or "-", r["type"], r["sha256"][:16], path))
+        exit(0)
+    if len(sys.argv) > 2 and sys.argv[1].lower() == "usage":
+        # CloverExtractor.command usage /Volumes/EFI
+        print("\n\n".join("\n".join(space.format_usage(x)) for x in sys.argv[2:]))
+        exit(0)
+    if len(sys.argv) > 1 and sys.argv[1].lower() == "bench":
+        # CloverExtractor.command bench [/path/to/baseline.json] [options]
+        exit(benchmark.main(sys.argv[2:]))
+    # --plan shows what each install would do without doing it
+    plan_only = "--plan" in sys.argv
+    if plan_only:
+        sys.argv.remove("--plan")
+    # --verify checks everything written against the package afterward
+    verify_install = "--verify" in sys.argv
+    if verify_install:
+        sys.argv.remove("--verify")
+    # --trace /path/to/trace.json records every command we run - Chrome trace events for
+    # .json, JSON Lines otherwise
+    if "--trace" in sys.argv:
+        i = sys.argv.index("--trace")
+        trace_path = sys.argv[i+1] if len(sys.argv) > i+1 else "CloverExtractor.trace.json"
+        del sys.argv[i:i+2]
+        trace_path = os.path.abspath(trace_path)
+        run.set_tracer(tracing.Tracer())
+        def save_trace():
+            run.get_tracer().export(trace_path)
+            print("{} - saved to {}".format(run.get_tracer().summary(), trace_path))
+            print(run.Run().cache_summary())
+        atexit.register(save_trace)
+    with run.Run().span("startup"):
+        c = CloverExtractor()
+    if verify_install:
+        c.settings["verify_install"] = True
     # Check for args
     if len(sys.argv) > 1:
         # We got command line args!
@@ -947,6 +1357,6 @@ if __name__ == '__main__':
                 c.clean_sources(c.tool_sources)
         else:
             args = sys.argv[1:]
-        c.quiet_copy(args)
+        c.quiet_copy(args, plan_only)
     else:
         c.main()
@@ -1,4 +1,6 @@
 from os.path import dirname, basename, isfile
-import glob
+import glob, sys
 modules = glob.glob(dirname(__file__)+"/*.py")
-__all__ = [ basename(f)[:-3] for f in modules if isfile(f) and not f.endswith('__init__.py')]
\ No newline at end of file
+# Modules that need asyncio (and its async/await syntax) - they won't even parse on older pythons
+async_modules = ["runasync"]
+__all__ = [ basename(f)[:-3] for f in modules if isfile(f) and not f.endswith('__init__.py') and (sys.version_info >= (3,5) or not basename(f)[:-3] in async_modules)]
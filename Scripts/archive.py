@@ -0,0 +1,147 @@
+import sys, os, re, json, time
+sys.path.append(os.path.abspath(os.path.dirname(os.path.realpath(__file__))))
+import hashing
+
+class ArchiveStore:
+
+    '''
+    Tracks the old Clover binaries archived on an EFI.  Each unique binary
+    (by SHA-256) is kept once - as CLOVERX64_r####.efi in the CLOVER folder,
+    or BOOTX64_r####.efi in BOOT - and a small index next to them records
+    the other names it was archived under.  Nothing here touches the disk -
+    plan() hands back ops for the installer to carry out.
+    '''
+
+    def __init__(self, root, **kwargs):
+        self.root    = root
+        self.keep    = kwargs.get("keep", 5)   # Most archives to hold - 0 for no limit
+        self.budget  = kwargs.get("budget", 0) # Most bytes they can take up - 0 for no limit
+        self.hasher  = kwargs.get("hasher", hashing.hash_file)
+        self.index   = os.path.join(root, "EFI", "CLOVER", ".archive.json")
+        self.folders = ((("EFI", "CLOVER"), "CLOVERX64"), (("EFI", "BOOT"), "BOOTX64"))
+        self.name_re = re.compile(r"^(CLOVERX64|BOOTX64)_r(.+)\.efi$", re.I)
+        self.entries = []
+
+    def _rel(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, "/")
+
+    def _abs(self, rel):
+        return os.path.join(self.root, *rel.split("/"))
+
+    def load(self):
+        # Reads the index and squares it with what's actually on disk - adopting any
+        # archives it doesn't know about.  Returns the entries, oldest first.
+        try:
+            with open(self.index) as f:
+                indexed = json.load(f).get("entries", [])
+        except Exception:
+            indexed = []
+        entries = {}
+        for e in indexed:
+            path = self._abs(e.get("path", ""))
+            if not os.path.isfile(path):
+                # Deleted out from under us
+                continue
+            if os.path.getsize(path) != e.get("size"):
+                # Swapped for something else - take another look
+                e["sha256"] = self.hasher(path)
+                e["size"] = os.path.getsize(path)
+            e["aliases"] = e.get("aliases", [])
+            entries[e["path"]] = e
+        for folder,prefix in self.folders:
+            path = os.path.join(self.root, *folder)
+            if not os.path.isdir(path):
+                continue
+            for name in sorted(os.listdir(path)):
+                m = self.name_re.match(name)
+                if not m or m.group(1).upper() != prefix:
+                    continue
+                full = os.path.join(path, name)
+                if self._rel(full) in entries:
+                    continue
+                entries[self._rel(full)] = {
+                    "path" : self._rel(full),
+                    "sha256" : self.hasher(full),
+                    "size" : os.path.getsize(full),
+                    "revision" : m.group(2),
+                    "archived" : os.path.getmtime(full),
+                    "aliases" : []
+                }
+        # Oldest first - and CLOVER ahead of BOOT so it's the copy we keep of any duplicates
+        self.entries = sorted(entries.values(), key=lambda x: (x.get("archived", 0), not x["path"].startswith("EFI/CLOVER/"), x["path"]))
+        return self.entries
+
+    def _remove_op(self, entry, message):
+        return {"op":"remove", "target":self._abs(entry["path"]), "bytes":0, "freed":entry["size"], "message":message}
+
+    def plan(self, incoming = [], reserve = 0):
+        # Works out how to archive the incoming binaries - a list of dicts with the source
+        # path, archive target, sha256, size, and revision of each - then drops duplicates
+        # and prunes oldest first down to the retention policy.  Pass reserve to prune
+        # until that many more bytes have been freed as well.  Returns (ops, entries) - the
+        # entries being what the index should hold afterward.
+        ops  = []
+        kept = []
+        seen = {}
+        for e in [dict(x, aliases=list(x["aliases"])) for x in self.entries]:
+            if e["sha256"] in seen:
+                # Same binary archived twice - keep the older copy and remember the name
+                seen[e["sha256"]]["aliases"].append(e["path"])
+                ops.append(self._remove_op(e, "  Removing {} - same as {}".format(os.path.basename(e["path"]), os.path.basename(seen[e["sha256"]]["path"]))))
+                continue
+            seen[e["sha256"]] = e
+            kept.append(e)
+        now = time.time()
+        for i in incoming:
+            target = self._rel(i["target"])
+            if i["sha256"] in seen:
+                # Already have it - the live copy can just be replaced
+                if target != seen[i["sha256"]]["path"] and not target in seen[i["sha256"]]["aliases"]:
+                    seen[i["sha256"]]["aliases"].append(target)
+                note = {"op":"note", "target":None, "bytes":0, "message":"  {} is already archived as {}".format(os.path.basename(i["source"]), os.path.basename(seen[i["sha256"]]["path"])), "verbose":True}
+                ops.append(note)
+                if "op" in seen[i["sha256"]]:
+                    # Leaning on another incoming archive - which may yet get dropped
+                    seen[i["sha256"]]["deps"].append((note, i["source"]))
+                continue
+            for e in [x for x in kept if x["path"] == target]:
+                # The move lands on top of this one
+                kept.remove(e)
+                ops.append({"op":"note", "target":None, "bytes":0, "message":"{} already exists - replacing...".format(os.path.basename(i["target"])), "verbose":True})
+            e = {"path":target, "sha256":i["sha256"], "size":i["size"], "revision":i["revision"], "archived":now, "aliases":[], "deps":[]}
+            e["op"] = {"op":"move", "source":i["source"], "target":i["target"], "bytes":0, "message":"  Renaming {} to {}".format(os.path.basename(i["source"]), os.path.basename(i["target"])), "verbose":True}
+            ops.append(e["op"])
+            seen[i["sha256"]] = e
+            kept.append(e)
+        # Prune oldest first - only removals made before anything new lands count toward
+        # reserve, so once we're making room every prune goes early
+        total = sum(x["size"] for x in kept)
+        freed = 0
+        while kept:
+            over_keep   = self.keep and len(kept) > self.keep
+            over_budget = self.budget and total > self.budget
+            if not (over_keep or over_budget or freed < reserve):
+                break
+            e = kept.pop(0)
+            total -= e["size"]
+            if "op" in e:
+                # Never made it in - just let the live copy be replaced.  That frees nothing
+                # while staging, and anything deduped against it isn't archived either.
+                ops.remove(e["op"])
+                ops.append({"op":"note", "target":None, "bytes":0, "message":"  Not archiving {} - no room".format(os.path.basename(e["op"]["source"])), "verbose":True})
+                for note,source in e["deps"]:
+                    ops.remove(note)
+                    ops.append({"op":"note", "target":None, "bytes":0, "message":"  Not archiving {} - no room".format(os.path.basename(source)), "verbose":True})
+                continue
+            freed += e["size"]
+            op = self._remove_op(e, "  Pruning {} ({:,} bytes)".format(os.path.basename(e["path"]), e["size"]))
+            if reserve:
+                # Making room - it needs to be gone before anything new lands
+                op["early"] = True
+            ops.append(op)
+        return (ops, [dict((x,y) for x,y in e.items() if not x in ("op", "deps")) for e in kept])
+
+    def index_op(self, entries):
+        # Returns an op that writes the passed entries out as the new index
+        data = json.dumps({"updated":time.time(), "entries":entries}, indent=2)
+        return {"op":"index", "target":self.index, "data":data, "bytes":len(data)}
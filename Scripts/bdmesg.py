@@ -1,4 +1,9 @@
-import binascii, subprocess, sys
+import binascii, subprocess, sys, os
+sys.path.append(os.path.abspath(os.path.dirname(os.path.realpath(__file__))))
+import run
+
+# The boot log can't change until we reboot - so there's no need to ask ioreg twice
+IOREG_TTL = 3600
 
 def get_clover_uuid():
     bd = bdmesg()
@@ -49,9 +54,7 @@ def _decode(var):
 
 def _bdmesg(comm):
     # Runs ioreg -l -p IODeviceTree -w0 and searches for "boot-log"
-    p = subprocess.Popen(comm, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    bd, be = p.communicate()
-    bd = _decode(bd)
+    bd = run.Run().run({"args":comm, "cache":IOREG_TTL})[0]
     for line in bd.split("\n"):
         # We're just looking for the "boot-log" property, then we need to format it
         if not '"boot-log"' in line:
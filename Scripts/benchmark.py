@@ -0,0 +1,282 @@
+import sys, os, io, time, json, struct, zlib, gzip, hashlib, shutil, tempfile, argparse, multiprocessing
+sys.path.append(os.path.abspath(os.path.dirname(os.path.realpath(__file__))))
+import extractor
+try:
+    import lzma
+except ImportError:
+    lzma = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+class SyntheticPackage:
+
+    '''
+    Builds fake Clover install packages - a xar holding an EFIFolder.pkg,
+    a Utils.pkg, and a number of driver sub-packages, each with a gzip or
+    pbzx compressed cpio Payload.  Drivers are minimal PE32+ images and the
+    EFIFolder carries a pile of theme files we never extract.
+    '''
+
+    def __init__(self, **kwargs):
+        self.packages     = kwargs.get("packages", 20)       # Driver sub-packages
+        self.drivers      = kwargs.get("drivers", 2)         # .efi files per driver sub-package
+        self.driver_size  = kwargs.get("driver_size", 65536)
+        self.clover_size  = kwargs.get("clover_size", 1048576)
+        self.junk         = kwargs.get("junk", 200)          # Theme/doc files in EFIFolder.pkg
+        self.junk_size    = kwargs.get("junk_size", 32768)
+        self.compression  = kwargs.get("compression", "gzip") # gzip or pbzx
+        self.revision     = kwargs.get("revision", "5150")
+
+    def _data(self, size, seed):
+        # Half noise, half zeroes - compresses roughly like real binaries
+        out = b""
+        block = hashlib.sha256(seed.encode("utf-8")).digest()
+        while len(out) < size:
+            block = hashlib.sha256(block).digest()
+            out += block * 2 + b"\x00" * 64
+        return out[:size]
+
+    def pe(self, size, subsystem = 11, data = b"", seed = ""):
+        # A minimal PE32+ image with a .text and .data section
+        code = self._data(max(0, size - len(data) - 1024), seed or str(size))
+        dos  = bytearray(64)
+        dos[:2] = b"MZ"
+        struct.pack_into("<I", dos, 0x3C, 64)
+        opt  = bytearray(240)
+        struct.pack_into("<H", opt, 0, 0x20b)
+        struct.pack_into("<H", opt, 68, subsystem)
+        t_off = 512
+        t_len = (len(code) + 511) // 512 * 512
+        d_off = t_off + t_len
+        d_len = (len(data) + 511) // 512 * 512
+        struct.pack_into("<I", opt, 56, d_off + d_len)
+        coff = b"PE\x00\x00" + struct.pack("<HHIIIHH", 0x8664, 2, 0, 0, 0, len(opt), 0x22)
+        secs = struct.pack("<8sIIIIIIHHI", b".text", len(code), t_off, t_len, t_off, 0, 0, 0, 0, 0x60000020)
+        secs += struct.pack("<8sIIIIIIHHI", b".data", len(data), d_off, d_len, d_off, 0, 0, 0, 0, 0xC0000040)
+        img = bytes(dos) + coff + bytes(opt) + secs
+        return img + b"\x00" * (t_off - len(img)) + code.ljust(t_len, b"\x00") + data.ljust(d_len, b"\x00")
+
+    def cpio(self, files):
+        # odc cpio - files is a list of (name, data, mode)
+        out = io.BytesIO()
+        for i,(name, data, mode) in enumerate(list(files) + [("TRAILER!!!", b"", 0)]):
+            n = name.encode("utf-8") + b"\x00"
+            out.write(b"070707" + ("%06o%06o%06o%06o%06o%06o%06o%011o%06o%011o" % (0, i+1, mode, 0, 0, 1, 0, 0, len(n), len(data))).encode("utf-8"))
+            out.write(n)
+            out.write(data)
+        return out.getvalue()
+
+    def compress(self, data):
+        if self.compression == "pbzx":
+            if lzma is None:
+                raise ValueError("lzma support is required for pbzx payloads")
+            chunk = 1048576
+            out = io.BytesIO()
+            out.write(b"pbzx" + struct.pack(">Q", chunk))
+            for i in range(0, len(data), chunk):
+                c = lzma.compress(data[i:i+chunk], format=lzma.FORMAT_XZ)
+                out.write(struct.pack(">QQ", chunk, len(c)))
+                out.write(c)
+            return out.getvalue()
+        out = io.BytesIO()
+        with gzip.GzipFile(fileobj=out, mode="wb", compresslevel=6) as f:
+            f.write(data)
+        return out.getvalue()
+
+    def xar(self, subs):
+        # subs is a list of (name, payload) - payloads are stored as-is like pkgbuild does
+        heap = io.BytesIO()
+        toc  = ['<?xml version="1.0" encoding="UTF-8"?><xar><toc>']
+        toc.append('<checksum style="sha1"><offset>0</offset><size>20</size></checksum>')
+        heap.write(b"\x00" * 20)
+        fid = 1
+        for name,data in subs:
+            offset = heap.tell()
+            heap.write(data)
+            toc.append('<file id="{}"><name>{}</name><type>directory</type>'.format(fid, name))
+            toc.append('<file id="{}"><name>Payload</name><type>file</type><data><length>{}</length><offset>{}</offset><size>{}</size><encoding style="application/octet-stream"/></data></file></file>'.format(fid+1, len(data), offset, len(data)))
+            fid += 2
+        toc.append('</toc></xar>')
+        toc = "".join(toc).encode("utf-8")
+        toc_comp = zlib.compress(toc)
+        return struct.pack(">4sHHQQI", b"xar!", 28, 1, len(toc_comp), len(toc), 1) + toc_comp + heap.getvalue()
+
+    def build(self, path):
+        # Writes the package to path and returns a dict describing what's in it
+        stats = {"payload_bytes" : 0, "members" : 0, "efi_files" : 0}
+        subs  = []
+        def add(name, files):
+            raw = self.cpio(files)
+            stats["payload_bytes"] += len(raw)
+            stats["members"] += len(files)
+            stats["efi_files"] += len([x for x in files if x[0].lower().endswith(".efi")])
+            subs.append((name, self.compress(raw)))
+        clover = self.pe(self.clover_size, 10, "Clover revision: {}".format(self.revision).encode("utf-8"), "clover")
+        efi = [("./EFI/CLOVER/CLOVERX64.efi", clover, 0o100644)]
+        efi.extend(("./EFI/CLOVER/themes/theme{}/{}.png".format(i//20, i), self._data(self.junk_size, "junk{}".format(i)), 0o100644) for i in range(self.junk))
+        add("EFIFolder.pkg", efi)
+        add("Utils.pkg", [("./usr/local/bin/{}".format(x), self._data(131072, x), 0o100755) for x in ("bdmesg", "boot1-install", "clover-genconfig")])
+        for p in range(self.packages):
+            files = [("./Driver{}_{}.efi".format(p, d), self.pe(self.driver_size, 11, seed="d{}_{}".format(p, d)), 0o100644) for d in range(self.drivers)]
+            files.append(("./Readme.txt", self._data(4096, "readme"), 0o100644))
+            add("Driver{}.UEFI.pkg".format(p), files)
+        with open(path, "wb") as f:
+            f.write(self.xar(subs))
+        stats["package_bytes"] = os.path.getsize(path)
+        stats["sub_packages"] = len(subs)
+        return stats
+
+def _peak_rss():
+    # Peak RSS in bytes for us and any reaped children (our pool workers)
+    if resource is None:
+        return None
+    scale = 1 if sys.platform == "darwin" else 1024 # ru_maxrss is KiB on Linux, bytes on macOS
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale
+
+def _run_scenario(scenario, package, q):
+    # Runs in its own process so the peak RSS belongs to just this scenario
+    try:
+        e = extractor.Extractor(workers=scenario.get("workers", 0))
+        temp = tempfile.mkdtemp()
+        out = open(os.devnull, "w")
+        stdout, sys.stdout = sys.stdout, out # The extractor is chatty
+        try:
+            start = time.time()
+            if scenario.get("index"):
+                e.index(package)
+            else:
+                e.extract(package, temp, True, scenario.get("memory", 0))
+            elapsed = time.time() - start
+        finally:
+            sys.stdout = stdout
+            out.close()
+            shutil.rmtree(temp, ignore_errors=True)
+        q.put({"seconds" : elapsed, "peak_rss" : _peak_rss()})
+    except Exception as ex:
+        q.put({"error" : str(ex)})
+
+class Benchmark:
+
+    def __init__(self, **kwargs):
+        self.iterations = kwargs.get("iterations", 3)
+        self.tolerance  = kwargs.get("tolerance", 0.25)
+        self.scenarios  = kwargs.get("scenarios", [
+            {"name" : "serial", "workers" : 1},
+            {"name" : "parallel", "workers" : 0},
+            {"name" : "memory", "workers" : 0, "memory" : 268435456},
+            {"name" : "index", "workers" : 0, "index" : True}
+        ])
+
+    def run_scenario(self, scenario, package):
+        q = multiprocessing.Queue()
+        p = multiprocessing.Process(target=_run_scenario, args=(scenario, package, q))
+        p.start()
+        out = q.get()
+        p.join()
+        return out
+
+    def run(self, package, stats):
+        # Returns a dict of scenario name : results - best of self.iterations
+        results = {}
+        for s in self.scenarios:
+            runs = [self.run_scenario(s, package) for x in range(self.iterations)]
+            errors = [x["error"] for x in runs if "error" in x]
+            if errors:
+                results[s["name"]] = {"error" : errors[0]}
+                continue
+            best = min(x["seconds"] for x in runs)
+            results[s["name"]] = {
+                "seconds" : round(best, 4),
+                "package_mb_s" : round(stats["package_bytes"] / 1000000.0 / best, 2) if best else None,
+                "payload_mb_s" : round(stats["payload_bytes"] / 1000000.0 / best, 2) if best else None,
+                "files_s" : round(stats["members"] / best, 1) if best else None,
+                "peak_rss" : max(x["peak_rss"] for x in runs) if runs[0]["peak_rss"] is not None else None
+            }
+        return results
+
+    def compare(self, results, baseline):
+        # Returns a list of (scenario, baseline seconds, seconds) that got slower than tolerance allows
+        regressions = []
+        for name,r in results.items():
+            b = baseline.get("results", {}).get(name, {})
+            if not "seconds" in r or not "seconds" in b:
+                continue
+            if r["seconds"] > b["seconds"] * (1 + self.tolerance):
+                regressions.append((name, b["seconds"], r["seconds"]))
+        return regressions
+
+def main(args = None):
+    parser = argparse.ArgumentParser(prog="CloverExtractor.command bench", description="Times the extraction pipeline against a synthetic Clover package.")
+    parser.add_argument("baseline", nargs="?", help="JSON baseline to compare against - written if it doesn't exist")
+    parser.add_argument("-u", "--update", action="store_true", help="overwrite the baseline with these results")
+    parser.add_argument("-p", "--packages", type=int, default=20, help="driver sub-packages (default 20)")
+    parser.add_argument("-d", "--drivers", type=int, default=2, help=".efi drivers per sub-package (default 2)")
+    parser.add_argument("-s", "--driver-size", type=int, default=65536, help="bytes per driver (default 65536)")
+    parser.add_argument("-j", "--junk", type=int, default=200, help="unused theme files in EFIFolder.pkg (default 200)")
+    parser.add_argument("-c", "--compression", choices=["gzip","pbzx"], default="gzip", help="Payload compression (default gzip)")
+    parser.add_argument("-i", "--iterations", type=int, default=3, help="runs per scenario - the best is kept (default 3)")
+    parser.add_argument("-t", "--tolerance", type=float, default=0.25, help="allowed slowdown vs the baseline (default 0.25)")
+    parser.add_argument("-k", "--keep", help="also save the generated package to this path")
+    a = parser.parse_args(args)
+    config = {
+        "packages" : a.packages,
+        "drivers" : a.drivers,
+        "driver_size" : a.driver_size,
+        "junk" : a.junk,
+        "compression" : a.compression
+    }
+    temp = tempfile.mkdtemp()
+    try:
+        package = os.path.join(temp, "Clover.pkg")
+        print("Generating synthetic package...")
+        stats = SyntheticPackage(**config).build(package)
+        print(" - {:,} bytes, {} sub-packages, {:,} members ({:,} bytes decoded)".format(stats["package_bytes"], stats["sub_packages"], stats["members"], stats["payload_bytes"]))
+        if a.keep:
+            shutil.copy(package, a.keep)
+        b = Benchmark(iterations=a.iterations, tolerance=a.tolerance)
+        results = b.run(package, stats)
+    finally:
+        shutil.rmtree(temp, ignore_errors=True)
+    print("")
+    print("{:<10} {:>9} {:>11} {:>11} {:>10} {:>10}".format("Scenario", "Seconds", "Pkg MB/s", "Data MB/s", "Files/s", "Peak RSS"))
+    for name in [x["name"] for x in b.scenarios]:
+        r = results[name]
+        if "error" in r:
+            print("{:<10} Error: {}".format(name, r["error"]))
+            continue
+        rss = "{:.1f} MB".format(r["peak_rss"] / 1000000.0) if r["peak_rss"] else "-"
+        print("{:<10} {:>9.4f} {:>11} {:>11} {:>10} {:>10}".format(name, r["seconds"], r["package_mb_s"], r["payload_mb_s"], r["files_s"], rss))
+    report = {
+        "created" : time.time(),
+        "python" : sys.version.split(" ")[0],
+        "platform" : sys.platform,
+        "cpus" : multiprocessing.cpu_count(),
+        "config" : config,
+        "stats" : stats,
+        "results" : results
+    }
+    if not a.baseline:
+        return 0
+    if os.path.exists(a.baseline) and not a.update:
+        with open(a.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != config:
+            print("\nBaseline was recorded with a different config - not comparing.")
+            return 0
+        regressions = b.compare(results, baseline)
+        if regressions:
+            print("\nRegressions vs {}:".format(a.baseline))
+            for name,old,new in regressions:
+                print(" - {}: {:.4f}s --> {:.4f}s".format(name, old, new))
+            return 1
+        print("\nNo regressions vs {}.".format(a.baseline))
+        return 0
+    with open(a.baseline, "w") as f:
+        json.dump(report, f, indent=2)
+    print("\nWrote baseline to {}.".format(a.baseline))
+    return 0
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,127 @@
+import os, re, threading
+from collections import deque
+
+class Capture:
+
+    '''
+    Holds onto a command's output in bounded memory.  Only the last few
+    KiB of each stream are kept - the full log can be spilled to a file
+    that rotates once it gets too big - and each complete line is handed
+    to any matchers as it comes in, so values can be pulled out of the
+    output without ever holding all of it.
+    '''
+
+    def __init__(self, **kwargs):
+        self.limit     = kwargs.get("limit", 65536)       # Characters of each stream to keep in memory
+        self.log       = kwargs.get("log", None)          # Path to spill the full output to
+        self.log_size  = kwargs.get("log_size", 10485760) # Rotate the log once it passes this many bytes
+        self.log_count = kwargs.get("log_count", 3)       # How many rotated logs to keep
+        self.on_line   = kwargs.get("on_line", None)      # Called with (stream, line) for every line
+        self.matchers  = []
+        self.matches   = {}
+        self.lock      = threading.Lock()
+        self.streams   = {}
+        self._log_file = None
+        self._log_len  = 0
+
+    def match(self, name, pattern, first = True):
+        # Watches stdout for the passed regex - the first group (or whole match) ends up in
+        # matches[name].  With first, later matches don't replace it.
+        self.matchers.append((name, re.compile(pattern), first))
+        return self
+
+    def _stream(self, stream):
+        if not stream in self.streams:
+            self.streams[stream] = {"chunks" : deque(), "size" : 0, "total" : 0, "partial" : ""}
+        return self.streams[stream]
+
+    def _rotate(self):
+        # log -> log.1 -> log.2 ... dropping anything past log_count
+        if self._log_file:
+            self._log_file.close()
+        for i in range(self.log_count, 0, -1):
+            src = self.log if i == 1 else "{}.{}".format(self.log, i-1)
+            dst = "{}.{}".format(self.log, i)
+            if os.path.exists(src):
+                if os.path.exists(dst):
+                    os.remove(dst)
+                os.rename(src, dst)
+        self._open_log()
+
+    def _open_log(self):
+        folder = os.path.dirname(self.log)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self._log_file = open(self.log, "wb")
+        self._log_len  = 0
+
+    def _spill(self, data):
+        if not self.log:
+            return
+        if self._log_file is None:
+            # Start fresh - any log from a prior run becomes log.1
+            self._rotate()
+        elif self.log_size and self._log_len >= self.log_size:
+            self._rotate()
+        self._log_file.write(data)
+        self._log_len += len(data)
+
+    def _line(self, stream, line):
+        if self.on_line:
+            self.on_line(stream, line)
+        if stream != "stdout":
+            return
+        for name,regex,first in self.matchers:
+            if first and name in self.matches:
+                continue
+            m = regex.search(line)
+            if m:
+                self.matches[name] = m.group(1) if regex.groups else m.group(0)
+
+    def feed(self, stream, text):
+        # Takes the next chunk of output for stream ("stdout" or "stderr")
+        if not text:
+            return
+        with self.lock:
+            s = self._stream(stream)
+            data = text if isinstance(text, bytes) else text.encode("utf-8")
+            s["total"] += len(data)
+            s["chunks"].append(text)
+            s["size"]  += len(text)
+            # Drop whole chunks from the front until we're back under the limit - then trim
+            # the one left straddling it
+            while s["size"] - len(s["chunks"][0]) >= self.limit and len(s["chunks"]) > 1:
+                s["size"] -= len(s["chunks"].popleft())
+            if s["size"] > self.limit:
+                s["chunks"][0] = s["chunks"][0][s["size"] - self.limit:]
+                s["size"] = self.limit
+            self._spill(data)
+            if not (self.on_line or self.matchers):
+                return
+            lines = (s["partial"] + text).split("\n")
+            s["partial"] = lines.pop()
+            if len(s["partial"]) > self.limit:
+                # No newline in sight - don't let one line grow without bound
+                s["partial"] = s["partial"][-self.limit:]
+            for line in lines:
+                self._line(stream, line.rstrip("\r"))
+
+    def close(self):
+        # Flushes out any trailing partial lines and closes the log
+        with self.lock:
+            for stream,s in self.streams.items():
+                if s["partial"]:
+                    self._line(stream, s["partial"].rstrip("\r"))
+                    s["partial"] = ""
+            if self._log_file:
+                self._log_file.close()
+                self._log_file = None
+
+    def text(self, stream = "stdout"):
+        # Returns what we've kept of the passed stream - at most limit characters of its tail
+        with self.lock:
+            return "".join(self.streams.get(stream, {}).get("chunks", []))
+
+    def size(self, stream = "stdout"):
+        # Returns how many bytes the passed stream has output in total
+        return self.streams.get(stream, {}).get("total", 0)
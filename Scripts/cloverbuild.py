@@ -1,6 +1,6 @@
-import sys, os, shutil, time, json
+import sys, os, shutil, time, json, re
 sys.path.append(os.path.abspath(os.path.dirname(os.path.realpath(__file__))))
-import run, reveal
+import run, reveal, capture
 
 class CloverBuild:
 
@@ -26,6 +26,8 @@ class CloverBuild:
         self.out        = os.path.join(self.c_path, "CloverPackage", "sym")
         # Setup the Clover EFI path
         self.ce_path    = os.path.join(self.c_path, "CloverPackage/CloverV2/EFI/CLOVER/drivers/off")
+        # Full build logs land here - only their tails are kept in memory
+        self.logs       = os.path.join(self.source, "logs")
         # Setup the efi drivers
         # Check if efi_drivers.json exists and load it if so
         self.efi_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "efi_drivers.json")
@@ -71,6 +73,10 @@ class CloverBuild:
         # Debug options
         self.debug      = kwargs.get("debug", False)
 
+    def _capture(self, name):
+        # Returns a capture that keeps the tail of a build step's output and logs the rest
+        return capture.Capture(log=os.path.join(self.logs, name + ".log"))
+
     def update_clover(self):
         # Updates Clover - or clones it if it doesn't exist
         if not os.path.exists(os.path.join(self.c_path, ".git")):
@@ -163,7 +169,7 @@ class CloverBuild:
                         raise Exception()
             print(" - Building...")
             # Run it
-            out = self.r.run({"args":[driver["lang"], driver["run"]], "stream":self.debug})
+            out = self.r.run({"args":[driver["lang"], driver["run"]], "stream":self.debug, "capture":self._capture(driver["path"])})
             if out[2] != 0:
                 print("Failed to build {}!".format(driver["path"]))
                 if self.verbose:
@@ -251,7 +257,7 @@ class CloverBuild:
         # Add the gettext prefix for our tools
         os.environ["GETTEXT_PREFIX"] = os.environ["TOOLCHAIN_DIR"]
         # Source edksetup.sh with BaseTools - may be completely broken currently :/
-        out = self.r.run({"args":["bash", "-c", "source edksetup.sh BaseTools"], "stream":self.debug})
+        out = self.r.run({"args":["bash", "-c", "source edksetup.sh BaseTools"], "stream":self.debug, "capture":self._capture("edksetup")})
         if out[2] != 0:
             print("Failed to setup environment!")
             if self.verbose:
@@ -261,7 +267,7 @@ class CloverBuild:
         # Build gettext, mtoc, and nasm (if needed)
         if not os.path.exists(os.path.join(self.source, "opt", "local", "bin", "gettext")):
             print(" - Building gettext...")
-            out = self.r.run({"args":["bash", "buildgettext.sh"], "stream":self.debug})
+            out = self.r.run({"args":["bash", "buildgettext.sh"], "stream":self.debug, "capture":self._capture("gettext")})
             if out[2] != 0:
                 print("Failed to build gettext!")
                 if self.verbose:
@@ -270,7 +276,7 @@ class CloverBuild:
                 return return_dict
         if not os.path.exists(os.path.join(self.source, "opt", "local", "bin", "mtoc.NEW")):
             print(" - Building mtoc...")
-            out = self.r.run({"args":["bash", "buildmtoc.sh"], "stream":self.debug})
+            out = self.r.run({"args":["bash", "buildmtoc.sh"], "stream":self.debug, "capture":self._capture("mtoc")})
             if out[2] != 0:
                 print("Failed to build mtoc!")
                 if self.verbose:
@@ -279,7 +285,7 @@ class CloverBuild:
                 return return_dict
         if not os.path.exists(os.path.join(self.source, "opt", "local", "bin", "nasm")):
             print(" - Building nasm...")
-            out = self.r.run({"args":["bash", "buildnasm.sh"], "stream":self.debug})
+            out = self.r.run({"args":["bash", "buildnasm.sh"], "stream":self.debug, "capture":self._capture("nasm")})
             if out[2] != 0:
                 print("Failed to build nasm!")
                 if self.verbose:
@@ -289,8 +295,8 @@ class CloverBuild:
         # Build Clover itself
         print("Building Clover...")
         out = self.r.run([
-            {"args":["bash", "ebuild.sh", "-fr","-mc","--no-usb","-D","NO_GRUB_DRIVERS_EMBEDDED","-t","XCODE8"], "stream":self.debug},
-            {"args":["bash", "ebuild.sh", "-fr","-D","NO_GRUB_DRIVERS_EMBEDDED","-t","XCODE8"], "stream":self.debug}
+            {"args":["bash", "ebuild.sh", "-fr","-mc","--no-usb","-D","NO_GRUB_DRIVERS_EMBEDDED","-t","XCODE8"], "stream":self.debug, "capture":self._capture("ebuild-mc")},
+            {"args":["bash", "ebuild.sh", "-fr","-D","NO_GRUB_DRIVERS_EMBEDDED","-t","XCODE8"], "stream":self.debug, "capture":self._capture("ebuild")}
         ], True)
         if type(out) is list:
             out = out[-1]
@@ -337,15 +343,13 @@ class CloverBuild:
             except:
                 print(" --> Patching failed :(")
             print(" - Running makepkg...")
-            out = self.r.run({"args":["bash", "../makepkg"], "stream":self.debug})
+            cap = self._capture("makepkg").match("pkg", re.escape("Package name: \x1b[39;49;00m") + "(.*)")
+            out = self.r.run({"args":["bash", "../makepkg"], "stream":self.debug, "capture":cap})
             if out[2] != 0:
                 print("Failed to create Clover install package!")
                 if self.verbose:
                     print(" - {}".format(out[1]))
-            try:
-                pack = out[0].split("Package name: [39;49;00m")[1].split("\n")[0].replace("\n", "").replace("\r", "")
-            except:
-                pack = None
+            pack = cap.matches.get("pkg", None)
             os.chdir(self.out)
             if pack != None and os.path.exists(pack):
                 print("\nBuilt {}!\n".format(pack))
@@ -368,13 +372,14 @@ class CloverBuild:
             except:
                 print(" --> Patching failed :(")
             print(" - Running makeiso...")
-            out = self.r.run({"args":["bash", "../makeiso"], "stream":self.debug})
+            cap = self._capture("makeiso").match("iso", "(CloverISO-.*)")
+            out = self.r.run({"args":["bash", "../makeiso"], "stream":self.debug, "capture":cap})
             if out[2] != 0:
                 print("Failed to create Clover ISO!")
                 if self.verbose:
                     print(" - {}".format(out[1]))
             try:
-                pack = "CloverISO-"+out[0].split("CloverISO-")[1].split("\n")[0].replace("\n", "").replace("\r", "")
+                pack = cap.matches["iso"]
                 iso_file = [x for x in os.listdir(pack) if x.lower().endswith(".iso") and not x.startswith(".")][0]
                 pack = os.path.join(self.out,pack,iso_file)
             except:
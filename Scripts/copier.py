@@ -0,0 +1,125 @@
+import sys, os, shutil, time, threading
+from multiprocessing.pool import ThreadPool
+
+class Copier:
+
+    '''
+    Queues up file copies and runs them in one go.  Ops are grouped by the
+    device they land on, and each device gets its own bounded thread pool
+    so several volumes stay busy at once without any one of them thrashing.
+    Everything is flushed once at the end of each device's batch rather
+    than after every file.
+    '''
+
+    def __init__(self, **kwargs):
+        self.workers = kwargs.get("workers", 4) # Per device
+        self.sync    = kwargs.get("sync", True)
+        self.ops     = []
+        self.stats   = {"files" : 0, "bytes" : 0, "errors" : 0, "seconds" : 0}
+
+    def _device(self, path):
+        # Walks up until we find something that exists - the target may not yet
+        while path and not os.path.exists(path):
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+        try:
+            return os.stat(path).st_dev
+        except OSError:
+            return None
+
+    def add(self, target, source = None, writer = None, device = None):
+        # Queues a copy of source to target - or a call to writer(target), which should
+        # write the file and return the bytes written.  Returns the op dict.
+        op = {
+            "target" : target,
+            "source" : source,
+            "writer" : writer,
+            "device" : device if device is not None else self._device(os.path.dirname(target)),
+            "bytes" : 0,
+            "error" : None
+        }
+        self.ops.append(op)
+        return op
+
+    def _copy(self, op):
+        try:
+            if op["writer"]:
+                written = op["writer"](op["target"])
+            else:
+                shutil.copy(op["source"], op["target"])
+                written = None
+            op["bytes"] = written if written is not None else os.path.getsize(op["target"])
+        except Exception as e:
+            op["error"] = e
+        return op
+
+    def _flush(self, ops):
+        # One sync for the whole batch - fsync each file where os.sync isn't available
+        if hasattr(os, "sync"):
+            os.sync()
+            return
+        for op in ops:
+            if op["error"] or not os.path.isfile(op["target"]):
+                continue
+            try:
+                fd = os.open(op["target"], os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError:
+                pass
+
+    def _run_device(self, ops):
+        workers = max(1, min(self.workers, len(ops)))
+        if workers == 1:
+            for op in ops:
+                self._copy(op)
+        else:
+            pool = ThreadPool(workers)
+            try:
+                pool.map(self._copy, ops)
+            finally:
+                pool.close()
+                pool.join()
+        if self.sync:
+            self._flush(ops)
+
+    def run(self):
+        # Runs everything queued and returns the ops in the order they were added - each
+        # with its bytes written and error (or None).  The queue is cleared.
+        ops, self.ops = self.ops, []
+        if not ops:
+            return []
+        devices = {}
+        for op in ops:
+            devices.setdefault(op["device"], []).append(op)
+        start = time.time()
+        if len(devices) == 1:
+            self._run_device(ops)
+        else:
+            threads = [threading.Thread(target=self._run_device, args=(x,)) for x in devices.values()]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.stats["seconds"] += time.time() - start
+        self.stats["files"]   += len([x for x in ops if not x["error"]])
+        self.stats["errors"]  += len([x for x in ops if x["error"]])
+        self.stats["bytes"]   += sum(x["bytes"] for x in ops if not x["error"])
+        return ops
+
+    def summary(self):
+        # Returns a one line rundown of everything this copier has done
+        s = self.stats
+        rate = s["bytes"] / 1048576.0 / s["seconds"] if s["seconds"] else 0
+        return "Copied {} file{} ({:,} bytes) in {:.2f}s - {:.1f} MB/s{}".format(
+            s["files"],
+            "" if s["files"] == 1 else "s",
+            s["bytes"],
+            s["seconds"],
+            rate,
+            "" if not s["errors"] else ", {} failed".format(s["errors"])
+        )
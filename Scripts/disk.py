@@ -10,11 +10,14 @@ class Disk:
 
     def __init__(self):
         self.r = run.Run()
+        # How long to reuse the disk listings for - mounting and unmounting through us
+        # always refreshes them
+        self.list_ttl = 5
         self.diskutil = self.get_diskutil()
         self.os_version = ".".join(
-            self.r.run({"args":["sw_vers", "-productVersion"]})[0].split(".")[:2]
+            self.r.run({"args":["sw_vers", "-productVersion"], "cache":3600})[0].split(".")[:2]
         )
-        self.full_os_version = self.r.run({"args":["sw_vers", "-productVersion"]})[0]
+        self.full_os_version = self.r.run({"args":["sw_vers", "-productVersion"], "cache":3600})[0]
         if len(self.full_os_version.split(".")) < 3:
             # Add .0 in case of 10.14
             self.full_os_version += ".0"
@@ -120,16 +123,16 @@ class Disk:
 
     def get_diskutil(self):
         # Returns the path to the diskutil binary
-        return self.r.run({"args":["which", "diskutil"]})[0].split("\n")[0].split("\r")[0]
+        return self.r.run({"args":["which", "diskutil"], "cache":3600})[0].split("\n")[0].split("\r")[0]
 
     def get_disks(self):
         # Returns a dictionary object of connected disks
-        disk_list = self.r.run({"args":[self.diskutil, "list", "-plist"]})[0]
+        disk_list = self.r.run({"args":[self.diskutil, "list", "-plist"], "cache":self.list_ttl, "cache_group":"disks"})[0]
         return self._get_plist(disk_list)
 
     def get_disk_text(self):
         # Returns plain text listing connected disks
-        return self.r.run({"args":[self.diskutil, "list"]})[0]
+        return self.r.run({"args":[self.diskutil, "list"], "cache":self.list_ttl, "cache_group":"disks"})[0]
 
     def get_disk_info(self, disk):
         disk_id = self.get_identifier(disk)
@@ -152,7 +155,7 @@ class Disk:
 
     def get_apfs(self):
         # Returns a dictionary object of apfs disks
-        output = self.r.run({"args":"echo y | " + self.diskutil + " apfs list -plist", "shell" : True})
+        output = self.r.run({"args":"echo y | " + self.diskutil + " apfs list -plist", "shell" : True, "cache":self.list_ttl, "cache_group":"disks"})
         if not output[2] == 0:
             # Error getting apfs info - return an empty dict
             return {}
@@ -340,6 +343,7 @@ class Disk:
         if not self._compare_versions(self.full_os_version, self.sudo_mount_version) and self.get_content(disk_id).lower() in self.sudo_mount_types:
             sudo = True
         out = self.r.run({"args":[self.diskutil, "mount", disk_id], "sudo":sudo})
+        self.r.invalidate(group="disks")
         self._update_disks()
         return out
 
@@ -348,6 +352,7 @@ class Disk:
         if not disk_id:
             return None
         out = self.r.run({"args":[self.diskutil, "unmount", disk_id]})
+        self.r.invalidate(group="disks")
         self._update_disks()
         return out
 
@@ -0,0 +1,243 @@
+import sys, os, mmap, threading, struct
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+sys.path.append(os.path.abspath(os.path.dirname(os.path.realpath(__file__))))
+import hashing
+
+class EfiInfo:
+
+    '''
+    Helpers to pull info out of EFI binaries.  Files are memory-mapped
+    rather than read in full, and results are memoized by path, size, and
+    mtime so repeat checks on the same file are free.  PE32/PE32+ images are
+    parsed so the version search starts with the data sections.
+    '''
+
+    def __init__(self, **kwargs):
+        self.max_cache = kwargs.get("max_cache", 256)
+        self.cache     = OrderedDict()
+        self.lock      = threading.Lock()
+        self.vers_hex  = "Clover revision: ".encode("utf-8")
+        self.data_sections = (".data", ".rdata")
+        self.machines  = {
+            0x014c : "IA32",
+            0x8664 : "X64",
+            0x01c2 : "ARM",
+            0x01c4 : "ARM",
+            0xaa64 : "AARCH64",
+            0x0ebc : "EBC"
+        }
+        self.subsystems = {
+            10 : "application",
+            11 : "boot service driver",
+            12 : "runtime driver",
+            13 : "rom"
+        }
+
+    def _get_key(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (os.path.realpath(path), st.st_size, getattr(st, "st_mtime_ns", st.st_mtime))
+
+    def _get_cached(self, key, field):
+        with self.lock:
+            if not key in self.cache or not field in self.cache[key]:
+                return (False, None)
+            # Move it to the end so it's the most recently used
+            value = self.cache.pop(key)
+            self.cache[key] = value
+            return (True, value[field])
+
+    def _set_cached(self, key, field, value):
+        with self.lock:
+            entry = self.cache.pop(key, {})
+            entry[field] = value
+            self.cache[key] = entry
+            while len(self.cache) > self.max_cache:
+                self.cache.popitem(last=False)
+
+    def forget(self, path):
+        # Drops anything cached for the passed path - call when the file gets replaced
+        path = os.path.realpath(path)
+        with self.lock:
+            for key in [x for x in self.cache if x[0] == path]:
+                self.cache.pop(key, None)
+
+    def clear_cache(self):
+        with self.lock:
+            self.cache.clear()
+
+    def parse_pe(self, s):
+        # Parses the headers and section table of a PE32/PE32+ image held in bytes
+        # or an mmap - returns None if it's not one
+        try:
+            if s[:2] != b"MZ":
+                return None
+            pe_off = struct.unpack_from("<I", s, 0x3C)[0]
+            if s[pe_off:pe_off+4] != b"PE\x00\x00":
+                return None
+            machine, sec_count, timestamp = struct.unpack_from("<HHI", s, pe_off+4)
+            opt_size = struct.unpack_from("<H", s, pe_off+20)[0]
+            opt_off  = pe_off+24
+            magic    = struct.unpack_from("<H", s, opt_off)[0]
+            if not magic in (0x10b, 0x20b):
+                return None
+            size_of_image = struct.unpack_from("<I", s, opt_off+56)[0]
+            subsystem     = struct.unpack_from("<H", s, opt_off+68)[0]
+            sections = []
+            sec_off  = opt_off+opt_size
+            for i in range(sec_count):
+                name, v_size, v_addr, raw_size, raw_off = struct.unpack_from("<8sIIII", s, sec_off+i*40)
+                flags = struct.unpack_from("<I", s, sec_off+i*40+36)[0]
+                sections.append({
+                    "name" : name.rstrip(b"\x00").decode("utf-8", "ignore"),
+                    "virtual_size" : v_size,
+                    "virtual_address" : v_addr,
+                    "raw_size" : raw_size,
+                    "raw_offset" : raw_off,
+                    "code" : bool(flags & 0x20) # IMAGE_SCN_CNT_CODE
+                })
+        except (struct.error, ValueError, TypeError):
+            return None
+        return {
+            "format" : "PE32+" if magic == 0x20b else "PE32",
+            "machine" : machine,
+            "machine_name" : self.machines.get(machine, "Unknown"),
+            "subsystem" : subsystem,
+            "subsystem_name" : self.subsystems.get(subsystem, "Unknown"),
+            "driver" : subsystem in (11, 12),
+            "timestamp" : timestamp,
+            "size_of_image" : size_of_image,
+            "sections" : sections
+        }
+
+    def _find_version(self, s, pe = None):
+        # Searches bytes, or an mmap, for "Clover revision: " and returns the digits that
+        # follow.  With PE info, the data sections are searched first - then the rest of the
+        # image, as GenFw and mtoc fold read-only strings into .text.
+        ranges = []
+        if pe is not None:
+            secs = [x for x in pe["sections"] if x["name"].lower() in self.data_sections]
+            if not secs:
+                # Oddly named sections - settle for anything that isn't code
+                secs = [x for x in pe["sections"] if not x["code"]]
+            ranges = [(x["raw_offset"], x["raw_offset"]+x["raw_size"]) for x in secs]
+        ranges.append((0, len(s)))
+        for start,end in ranges:
+            location = s.find(self.vers_hex, start, end)
+            if location == -1:
+                continue
+            location += len(self.vers_hex)
+            version = ""
+            while True:
+                c = s[location:location+1]
+                if not c or not c.isdigit():
+                    break
+                version += c.decode("utf-8")
+                location += 1
+            if len(version):
+                return version
+        return None
+
+    def get_version_from_bytes(self, s):
+        return self._find_version(s, self.parse_pe(s))
+
+    def _map_file(self, path, func):
+        # Runs func against an mmap of the file - mmap can't handle empty files
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return func(b"")
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return func(m)
+            finally:
+                m.close()
+
+    def get_info(self, path):
+        # Returns a dict with the PE info (or None) and clover version of the passed file
+        if not path:
+            return None
+        key = self._get_key(path)
+        if key is None:
+            return None
+        found,info = self._get_cached(key, "info")
+        if found:
+            return info
+        def _get(s):
+            pe = self.parse_pe(s)
+            return {"pe" : pe, "version" : self._find_version(s, pe), "size" : len(s)}
+        info = self._map_file(path, _get)
+        self._set_cached(key, "info", info)
+        return info
+
+    def get_pe_info(self, path):
+        info = self.get_info(path)
+        return info["pe"] if info else None
+
+    def get_clover_version(self, path):
+        # Attempts to get the clover version via binary string searching
+        info = self.get_info(path)
+        return info["version"] if info else None
+
+    def get_clover_versions(self, paths):
+        # Batch version of get_clover_version - returns a dict of path : version
+        return dict((p, self.get_clover_version(p)) for p in paths)
+
+    def get_hash(self, path):
+        # Returns the file's SHA-256 - memoized like everything else
+        key = self._get_key(path)
+        if key is None:
+            return None
+        found,h = self._get_cached(key, "sha256")
+        if found:
+            return h
+        h = hashing.hash_file(path)
+        self._set_cached(key, "sha256", h)
+        return h
+
+    def find_efi_files(self, path):
+        # Returns a sorted list of every .efi file under path - skipping hidden and ._ files
+        if os.path.isfile(path):
+            return [path]
+        out = []
+        for root,dirs,files in os.walk(path):
+            dirs[:] = [x for x in dirs if not x.startswith(".")]
+            out.extend(os.path.join(root,x) for x in files if x.lower().endswith(".efi") and not x.startswith("."))
+        return sorted(out)
+
+    def _scan_file(self, path):
+        try:
+            info = self.get_info(path)
+            pe = info["pe"] if info else None
+            return {
+                "path" : path,
+                "revision" : info["version"] if info else None,
+                "sha256" : self.get_hash(path),
+                "size" : info["size"] if info else None,
+                "type" : "Unknown" if not pe else pe["subsystem_name"],
+                "machine" : None if not pe else pe["machine_name"]
+            }
+        except Exception as e:
+            return {"path" : path, "error" : str(e)}
+
+    def scan(self, paths, workers = 8):
+        # Inspects every .efi under the passed path(s) across a thread pool and returns a
+        # list of dicts in path order.  Unchanged files are served from the cache.
+        if not isinstance(paths, (list, tuple)):
+            paths = [paths]
+        files = []
+        for p in paths:
+            files.extend(self.find_efi_files(p))
+        if not files:
+            return []
+        workers = max(1, min(workers, len(files)))
+        if workers == 1:
+            return [self._scan_file(x) for x in files]
+        pool = ThreadPool(workers)
+        try:
+            return pool.map(self._scan_file, files)
+        finally:
+            pool.close()
+            pool.join()
@@ -0,0 +1,259 @@
+import sys, os, shutil, tempfile, multiprocessing, hashlib
+sys.path.append(os.path.abspath(os.path.dirname(os.path.realpath(__file__))))
+import xar, payload, hashing
+
+def _bin_filter(name, target):
+    # Only the direct children of usr/local/bin
+    if not name.startswith("usr/local/bin/") or "/" in name[len("usr/local/bin/"):]:
+        return None
+    return os.path.join(target, os.path.basename(name))
+
+def _efi_filter(name, target):
+    # Only CLOVERX64.efi and top level .efi files
+    if name.lower() == "efi/clover/cloverx64.efi":
+        return os.path.join(target, "CLOVERX64.efi")
+    if not "/" in name and name.lower().endswith(".efi"):
+        return os.path.join(target, name)
+    return None
+
+def extract_package(job):
+    # Worker for a single sub-package - lives at the module level so it can be
+    # handed to a process pool.  Returns (pkg, [(name, path, data, sha256)], error) -
+    # data is only set for members kept in memory
+    try:
+        member_filter = _bin_filter if job["kind"] == "bin" else _efi_filter
+        with xar.XarStream(job["package"], job["offset"], job["length"], job["encoding"]) as f:
+            # Hash as we go so there's something to check the installed copies against
+            p = payload.Payload(f, digest="sha256")
+            if job.get("memory", 0) > 0 and job["kind"] == "efi":
+                out = p.read_members(lambda x: member_filter(x, job["target"]), job["memory"])
+            else:
+                out = [(x, y, None) for x,y in p.extract(lambda x: member_filter(x, job["target"]))]
+        return (job["pkg"], [(x, y, z, p.digests.get(x)) for x,y,z in out], None)
+    except Exception as e:
+        return (job["pkg"], [], str(e))
+
+def _get_revision(data, tail = b""):
+    # Looks for "Clover revision: ####" in tail+data - returns (revision, new tail)
+    vers_hex = "Clover revision: ".encode("utf-8")
+    s = tail + data
+    location = s.find(vers_hex)
+    if location != -1:
+        digits = b""
+        for c in bytearray(s[location+len(vers_hex):]):
+            if not 48 <= c <= 57:
+                break
+            digits += bytearray([c])
+        # Only trust it if the digits didn't run off the end of what we have
+        if digits and location+len(vers_hex)+len(digits) < len(s):
+            return (digits.decode("utf-8"), b"")
+    # Keep enough to catch a marker split across chunks
+    return (None, s[-(len(vers_hex)+16):])
+
+def index_package(job):
+    # Index worker - hashes every .efi member of a single sub-package and
+    # notes where it lives.  Returns (pkg, info, error)
+    info = {
+        "name" : job["pkg"],
+        "offset" : job["offset"],
+        "length" : job["length"],
+        "encoding" : job["encoding"],
+        "format" : None,
+        "size" : 0,
+        "members" : []
+    }
+    try:
+        with xar.XarStream(job["package"], job["offset"], job["length"], job["encoding"]) as f:
+            p = payload.Payload(f)
+            info["format"] = p.format
+            for m in p.members():
+                if m["type"] != "file" or not m["name"].lower().endswith(".efi"):
+                    continue
+                h = hashlib.sha256()
+                rev, tail = None, b""
+                scan = m["name"].lower() == "efi/clover/cloverx64.efi"
+                while True:
+                    data = p.read(p.chunk)
+                    if not data:
+                        break
+                    h.update(data)
+                    if scan and not rev:
+                        rev,tail = _get_revision(data, tail)
+                if (job["encoding"] or "application/octet-stream").lower() == "application/octet-stream":
+                    source,skip = p.locate(m)
+                else:
+                    # The heap entry itself is encoded - we have to decode from the top
+                    source,skip = 0, m["offset"]
+                member = {
+                    "name" : m["name"],
+                    "size" : m["size"],
+                    "offset" : m["offset"],
+                    "compressed_offset" : job["offset"] + source,
+                    "skip" : skip,
+                    "sha256" : h.hexdigest()
+                }
+                if scan:
+                    member["revision"] = rev
+                info["members"].append(member)
+            # Walk off the end so we know the decoded size
+            for m in p.members():
+                pass
+            info["size"] = p.position
+        return (job["pkg"], info, None)
+    except Exception as e:
+        return (job["pkg"], info, str(e))
+
+class Extractor:
+
+    '''
+    Pulls CLOVERX64.efi, the EFI drivers, and the usr/local/bin tools out of
+    a Clover install package.  Sub-packages are independent, so their Payloads
+    can be decoded across a pool of processes.
+    '''
+
+    def __init__(self, **kwargs):
+        self.workers = kwargs.get("workers", 0)
+
+    def get_workers(self, jobs):
+        # 0 or less means one per core - never more than we have jobs
+        workers = self.workers
+        if workers <= 0:
+            try:
+                workers = multiprocessing.cpu_count()
+            except NotImplementedError:
+                workers = 1
+        return max(1, min(workers, jobs))
+
+    def get_jobs(self, package, stage = None, full = True):
+        # Builds the ordered job list for the passed package
+        flat = xar.Xar(package)
+        jobs = []
+        pkgs = sorted([x for x in flat.list_dir() if x.lower().endswith(".pkg") and flat.get_file(x + "/Payload")])
+        # Extract the Utils.pkg first so we can update the local /usr/local/bin
+        pkgs = [x for x in pkgs if x.lower() == "utils.pkg"] + [x for x in pkgs if x.lower() != "utils.pkg"]
+        for pkg in pkgs:
+            kind = "bin" if pkg.lower() == "utils.pkg" else "efi"
+            if kind == "efi" and not pkg.lower() == "efifolder.pkg" and not full:
+                # We only want Clover
+                continue
+            entry = flat.get_file(pkg + "/Payload")
+            jobs.append({
+                "pkg" : pkg,
+                "kind" : kind,
+                "package" : package,
+                "offset" : flat.heap_start + entry["offset"],
+                "length" : entry["length"],
+                "encoding" : entry["encoding"],
+                "target" : os.path.join(stage, str(len(jobs))) if stage else None
+            })
+        return jobs
+
+    def run_jobs(self, jobs, workers, worker = extract_package):
+        # Yields the results in job order regardless of how they're run
+        if workers > 1:
+            try:
+                pool = multiprocessing.Pool(workers)
+            except Exception:
+                # Couldn't spin up the pool - fall back on running serially
+                pool = None
+            if pool:
+                try:
+                    for out in pool.imap(worker, jobs):
+                        yield out
+                finally:
+                    pool.close()
+                    pool.join()
+                return
+        for job in jobs:
+            yield worker(job)
+
+    def extract(self, package, out_dir, full = True, memory = 0):
+        # Extracts into efi_drivers and binaries folders within out_dir and returns
+        # the (efi_drivers, binaries) dicts - or False if the package can't be read.
+        # If memory is set, up to that many bytes of .efi files are kept in memory
+        # under a "data" key instead of being written out - the binaries always
+        # land on disk as we need a path to hand to cp.
+        stage = tempfile.mkdtemp(dir=out_dir)
+        try:
+            jobs = self.get_jobs(package, stage, full)
+        except Exception as e:
+            shutil.rmtree(stage, ignore_errors=True)
+            print("xar", str(e))
+            return False
+        workers = self.get_workers(len(jobs))
+        # Every running job holds its members (and the pickled copy it sends back) at the
+        # same time - so each gets an equal share of the budget rather than all of it
+        for job in jobs:
+            job["memory"] = memory // max(1, workers)
+        e = os.path.join(out_dir, "efi_drivers")
+        b = os.path.join(out_dir, "binaries")
+        el = {} # The EFI driver list
+        bn = {} # The binary list
+        if not os.path.exists(e):
+            os.mkdir(e)
+        if not os.path.exists(b):
+            os.mkdir(b)
+        if workers > 1:
+            print("Extracting {} package{} across {} workers...".format(len(jobs), "" if len(jobs) == 1 else "s", workers))
+        # Merge in job order so later packages win just as they would serially
+        for pkg,out,error in self.run_jobs(jobs, workers):
+            print("Extracting {}...".format(pkg))
+            if error:
+                print("Failed to extract {}: {}".format(pkg, error))
+                continue
+            for name,path,data,digest in out:
+                if pkg.lower() == "utils.pkg":
+                    x = os.path.basename(path)
+                    os.rename(path, os.path.join(b, x))
+                    bn[x] = { "path" : os.path.join(b, x), "show" : True, "selected" : True, "size" : os.path.getsize(os.path.join(b, x)) }
+                    if digest:
+                        bn[x]["sha256"] = digest
+                    continue
+                if name.lower() == "efi/clover/cloverx64.efi":
+                    key,entry = "CLOVERX64.efi", { "show" : False, "selected" : False }
+                else:
+                    key,entry = name, { "show" : True, "selected" : False }
+                if key in el and "data" in el[key]:
+                    # A later package replaces this one - give back its budget
+                    memory += len(el[key]["data"])
+                if data is not None and len(data) <= memory:
+                    memory -= len(data)
+                    entry["data"] = data
+                    entry["size"] = len(data)
+                elif data is not None:
+                    # Over budget - spill it
+                    with open(os.path.join(e, key), "wb") as f:
+                        f.write(data)
+                    entry["path"] = os.path.join(e, key)
+                    entry["size"] = len(data)
+                else:
+                    os.rename(path, os.path.join(e, key))
+                    entry["path"] = os.path.join(e, key)
+                    entry["size"] = os.path.getsize(entry["path"])
+                if digest:
+                    entry["sha256"] = digest
+                el[key] = entry
+        shutil.rmtree(stage, ignore_errors=True)
+        return (el, bn)
+
+    def index(self, package):
+        # Builds a manifest of every sub-package and .efi member in the package.
+        # Member offsets are within the decoded Payload - to reach one without
+        # decoding from the top, start decoding at compressed_offset and skip
+        # that many decoded bytes.
+        jobs = self.get_jobs(package)
+        manifest = {
+            "package" : os.path.basename(package),
+            "size" : os.path.getsize(package),
+            "sha256" : hashing.hash_file(package),
+            "clover_revision" : None,
+            "packages" : []
+        }
+        for pkg,info,error in self.run_jobs(jobs, self.get_workers(len(jobs)), index_package):
+            if error:
+                info["error"] = error
+            for m in info["members"]:
+                if m.get("revision"):
+                    manifest["clover_revision"] = m["revision"]
+            manifest["packages"].append(info)
+        return manifest
@@ -0,0 +1,15 @@
+import hashlib
+
+def hash_file(path, algorithm = "sha256", chunk = 1048576):
+    # Streams the passed file through the hash a chunk at a time and returns the hexdigest
+    h = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(chunk)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+def hash_bytes(data, algorithm = "sha256"):
+    return hashlib.new(algorithm, data).hexdigest()
@@ -0,0 +1,335 @@
+import sys, os, struct, zlib, bz2, hashlib
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+class DecodeStream:
+
+    '''
+    Base file-like reader - subclasses fill the buffer from the source
+    stream a chunk at a time in _fill().
+    '''
+
+    def __init__(self, source, data = b"", chunk = 1048576):
+        self.source = source
+        self.chunk  = chunk
+        self.buffer = data
+        self.pos    = 0
+        self.eof    = False
+
+    def locate(self, position):
+        # Returns the (source offset, decoded offset) to start decoding from in order
+        # to reach the passed decoded position - compressed streams have to start over
+        return (0, 0)
+
+    def _fill(self):
+        # Reads the next chunk straight through - returns False when exhausted
+        if self.eof:
+            return False
+        data = self.source.read(self.chunk)
+        if not data:
+            self.eof = True
+            return False
+        self._append(data)
+        return True
+
+    def _append(self, data):
+        if self.pos:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        self.buffer += data
+
+    def _read_source(self, size):
+        # Pulls exactly size bytes from the source - or less at EOF
+        data = b""
+        while len(data) < size:
+            d = self.source.read(size - len(data))
+            if not d:
+                break
+            data += d
+        return data
+
+    def read(self, size = -1):
+        if size is None or size < 0:
+            while self._fill():
+                pass
+            size = len(self.buffer) - self.pos
+        else:
+            while len(self.buffer) - self.pos < size and self._fill():
+                pass
+        data = self.buffer[self.pos:self.pos+size]
+        self.pos += len(data)
+        return data
+
+class RawStream(DecodeStream):
+
+    def locate(self, position):
+        # No encoding - the offsets line up
+        return (position, position)
+
+class GzipStream(DecodeStream):
+
+    def __init__(self, source, data = b"", chunk = 1048576):
+        DecodeStream.__init__(self, source, b"", chunk)
+        self.pending = data
+        self.decoder = zlib.decompressobj(16+zlib.MAX_WBITS)
+
+    def _fill(self):
+        if self.eof:
+            return False
+        data = self.pending or self.source.read(self.chunk)
+        self.pending = b""
+        if not data:
+            self.eof = True
+            self._append(self.decoder.flush())
+            return False
+        out = self.decoder.decompress(data)
+        if self.decoder.unused_data:
+            # Concatenated gzip members - start a new decoder on the leftovers
+            self.pending = self.decoder.unused_data
+            out += self.decoder.flush()
+            self.decoder = zlib.decompressobj(16+zlib.MAX_WBITS)
+        self._append(out)
+        return True
+
+class Bzip2Stream(DecodeStream):
+
+    def __init__(self, source, data = b"", chunk = 1048576):
+        DecodeStream.__init__(self, source, b"", chunk)
+        self.pending = data
+        self.decoder = bz2.BZ2Decompressor()
+
+    def _fill(self):
+        if self.eof:
+            return False
+        data = self.pending or self.source.read(self.chunk)
+        self.pending = b""
+        if not data:
+            self.eof = True
+            return False
+        self._append(self.decoder.decompress(data))
+        return True
+
+class PbzxStream(DecodeStream):
+
+    '''
+    Decodes Apple's pbzx container - a header followed by chunks that are
+    either xz compressed or stored as-is.
+    '''
+
+    def __init__(self, source, data = b"", chunk = 1048576):
+        DecodeStream.__init__(self, source, b"", chunk)
+        if lzma is None:
+            raise ValueError("lzma support is required for pbzx payloads")
+        # Let _read_source serve the bytes we already peeked
+        self.peeked  = data
+        self.offset  = 0 # Source bytes consumed
+        self.decoded = 0 # Decoded bytes produced
+        self.blocks  = [] # (decoded offset, source offset) for each chunk
+        head = self._read_source(12)
+        if len(head) < 12 or head[:4] != b"pbzx":
+            raise ValueError("Malformed pbzx header")
+
+    def _read_source(self, size):
+        data = self.peeked[:size]
+        self.peeked = self.peeked[size:]
+        if len(data) < size:
+            data += DecodeStream._read_source(self, size - len(data))
+        self.offset += len(data)
+        return data
+
+    def locate(self, position):
+        # Each chunk decodes on its own, so we can start at the one holding position
+        block = (0, 0)
+        for b in self.blocks:
+            if b[0] > position:
+                break
+            block = b
+        return (block[1], block[0])
+
+    def _fill(self):
+        if self.eof:
+            return False
+        start = self.offset
+        head = self._read_source(16)
+        if len(head) < 16:
+            self.eof = True
+            return False
+        flags, length = struct.unpack(">QQ", head)
+        data = self._read_source(length)
+        if len(data) < length:
+            raise ValueError("Truncated pbzx chunk")
+        if data[:6] == b"\xfd7zXZ\x00":
+            data = lzma.LZMADecompressor().decompress(data)
+        self.blocks.append((self.decoded, start))
+        self.decoded += len(data)
+        self._append(data)
+        return True
+
+class Payload:
+
+    '''
+    Streaming reader for pkg Payloads - gzip, bzip2, or pbzx compressed
+    (or bare) cpio archives in either the odc or newc flavor.  Members are
+    walked in order and anything the caller doesn't read is skipped.
+    '''
+
+    def __init__(self, source, chunk = 1048576, digest = None):
+        self.chunk    = chunk
+        self.digest   = digest # Hash algorithm for members we pull out, if any
+        self.digests  = {} # Member name : hexdigest
+        self.position = 0 # Decoded bytes consumed
+        self._left    = 0
+        self._pad     = 0
+        magic = b""
+        while len(magic) < 6:
+            d = source.read(6 - len(magic))
+            if not d:
+                break
+            magic += d
+        if magic[:2] == b"\x1f\x8b":
+            self.format, self.stream = "gzip", GzipStream(source, magic, chunk)
+        elif magic[:4] == b"pbzx":
+            self.format, self.stream = "pbzx", PbzxStream(source, magic, chunk)
+        elif magic[:3] == b"BZh":
+            self.format, self.stream = "bzip2", Bzip2Stream(source, magic, chunk)
+        elif magic[:4] == b"0707":
+            self.format, self.stream = "cpio", RawStream(source, magic, chunk)
+        else:
+            raise ValueError("Unknown Payload format")
+
+    def _pull(self, size):
+        data = self.stream.read(size)
+        self.position += len(data)
+        return data
+
+    def _read_exact(self, size):
+        data = self._pull(size)
+        if len(data) < size:
+            raise ValueError("Unexpected end of Payload")
+        return data
+
+    def _discard(self, size):
+        # Skips size bytes without holding more than a chunk at a time
+        while size > 0:
+            data = self._pull(min(self.chunk, size))
+            if not data:
+                raise ValueError("Unexpected end of Payload")
+            size -= len(data)
+
+    def _read_header(self):
+        magic = self._pull(6)
+        if not magic:
+            return None
+        if magic == b"070707":
+            # odc - all octal fields
+            h = self._read_exact(70)
+            mode, mtime = int(h[12:18], 8), int(h[42:53], 8)
+            name_size, size = int(h[53:59], 8), int(h[59:70], 8)
+            name = self._read_exact(name_size)
+            self._pad = 0
+        elif magic in (b"070701", b"070702"):
+            # newc/crc - all hex fields, header+name and data are 4-byte aligned
+            h = self._read_exact(104)
+            mode, mtime = int(h[8:16], 16), int(h[40:48], 16)
+            size, name_size = int(h[48:56], 16), int(h[88:96], 16)
+            name = self._read_exact(name_size)
+            self._discard((4 - (110 + name_size) % 4) % 4)
+            self._pad = (4 - size % 4) % 4
+        else:
+            raise ValueError("Unsupported cpio header")
+        name = name.rstrip(b"\x00").decode("utf-8", "ignore")
+        if name.startswith("./"):
+            name = name[2:]
+        return {
+            "name" : name.strip("/") if name != "." else "",
+            "mode" : mode,
+            "mtime" : mtime,
+            "size" : size,
+            "offset" : self.position,
+            "type" : "directory" if mode & 0o170000 == 0o040000 else "file" if mode & 0o170000 == 0o100000 else "other"
+        }
+
+    def members(self):
+        # Yields info dicts for each member - read() pulls the current member's data
+        while True:
+            self._discard(self._left + self._pad)
+            self._left = self._pad = 0
+            info = self._read_header()
+            if info is None or info["name"] == "TRAILER!!!":
+                return
+            self._left = info["size"]
+            yield info
+
+    def read(self, size = -1):
+        # Reads from the current member
+        if size is None or size < 0 or size > self._left:
+            size = self._left
+        if not size:
+            return b""
+        data = self._read_exact(size)
+        self._left -= len(data)
+        return data
+
+    def locate(self, info):
+        # Returns (source offset, decoded bytes to skip from there) to reach the member's data
+        source,decoded = self.stream.locate(info["offset"])
+        return (source, info["offset"] - decoded)
+
+    def _write(self, info, target):
+        # Streams the current member out to target
+        if not os.path.exists(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        h = hashlib.new(self.digest) if self.digest else None
+        with open(target, "wb") as f:
+            while True:
+                data = self.read(self.chunk)
+                if not data:
+                    break
+                f.write(data)
+                if h:
+                    h.update(data)
+        if h:
+            self.digests[info["name"]] = h.hexdigest()
+        try:
+            os.chmod(target, info["mode"] & 0o7777)
+        except:
+            pass
+
+    def extract(self, member_filter):
+        # member_filter takes a member name and returns the target path to write it to,
+        # or None to skip it.  Only regular files are written - returns a list of
+        # (name, target) tuples.
+        out = []
+        for info in self.members():
+            if info["type"] != "file":
+                continue
+            target = member_filter(info["name"])
+            if not target:
+                continue
+            self._write(info, target)
+            out.append((info["name"], target))
+        return out
+
+    def read_members(self, member_filter, limit = 16777216):
+        # Like extract() - but members are kept in memory until limit bytes have been
+        # buffered, anything past that spills to its target path.  Returns a list of
+        # (name, target, data) tuples - data is None for members that spilled.
+        out = []
+        for info in self.members():
+            if info["type"] != "file":
+                continue
+            target = member_filter(info["name"])
+            if not target:
+                continue
+            if info["size"] <= limit:
+                limit -= info["size"]
+                data = self.read()
+                if self.digest:
+                    self.digests[info["name"]] = hashlib.new(self.digest, data).hexdigest()
+                out.append((info["name"], target, data))
+                continue
+            self._write(info, target)
+            out.append((info["name"], target, None))
+        return out
@@ -0,0 +1,142 @@
+import sys, os, shutil, json, time, tempfile
+sys.path.append(os.path.abspath(os.path.dirname(os.path.realpath(__file__))))
+import hashing
+
+class PkgCache:
+
+    '''
+    Content-addressed cache of extracted Clover packages.  Each entry lives in
+    a folder named for the package's SHA-256 and holds the efi_drivers and
+    binaries folders alongside a meta.json.  Entries are evicted least
+    recently used first once the cache grows past its byte budget.
+    '''
+
+    def __init__(self, path, budget = 268435456):
+        self.path   = path
+        self.budget = budget
+        self.meta   = "meta.json"
+
+    def _check_path(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def _folder_size(self, path):
+        size = 0
+        for root,dirs,files in os.walk(path):
+            for f in files:
+                try:
+                    size += os.path.getsize(os.path.join(root,f))
+                except OSError:
+                    pass
+        return size
+
+    def _load_meta(self, key):
+        try:
+            with open(os.path.join(self.path, key, self.meta)) as f:
+                return json.load(f)
+        except:
+            return None
+
+    def _save_meta(self, key, meta):
+        # Write then rename so a reader never sees a half written file
+        m_path = os.path.join(self.path, key, self.meta)
+        with open(m_path + ".tmp", "w") as f:
+            json.dump(meta, f, indent=2)
+        os.rename(m_path + ".tmp", m_path)
+
+    def _expand(self, key, meta):
+        # Rebuilds the efi_drivers and binaries dicts with absolute paths
+        lists = []
+        for folder in ("efi_drivers", "binaries"):
+            out = {}
+            for name,info in meta.get(folder, {}).items():
+                entry = dict(info)
+                entry["path"] = os.path.join(self.path, key, folder, entry.pop("file"))
+                out[name] = entry
+            lists.append(out)
+        return tuple(lists)
+
+    def get_key(self, package):
+        return hashing.hash_file(package)
+
+    def get(self, key, full = True):
+        # Returns the cached (efi_drivers, binaries) for the key - or None on a miss.
+        # An entry extracted without the drivers can't serve a full request.
+        meta = self._load_meta(key)
+        if not meta or (full and not meta.get("full", False)):
+            return None
+        el,bn = self._expand(key, meta)
+        if not all(os.path.exists(x["path"]) for x in list(el.values()) + list(bn.values())):
+            # Something went missing - treat it as a miss
+            return None
+        meta["last_used"] = time.time()
+        try:
+            self._save_meta(key, meta)
+        except:
+            pass
+        return (el, bn)
+
+    def new_stage(self):
+        # Returns a fresh staging folder within the cache to extract into
+        self._check_path()
+        return tempfile.mkdtemp(dir=self.path)
+
+    def store(self, key, stage, efi_drivers, binaries, full = True, package = None):
+        # Commits a staging folder that holds the passed efi_drivers and binaries
+        # as the entry for key, and returns the lists pointed at their new home
+        meta = {
+            "package" : os.path.basename(package) if package else None,
+            "full" : full,
+            "created" : time.time(),
+            "last_used" : time.time(),
+            "size" : self._folder_size(stage)
+        }
+        for folder,entries in (("efi_drivers", efi_drivers), ("binaries", binaries)):
+            meta[folder] = {}
+            for name,info in entries.items():
+                entry = dict((x,y) for x,y in info.items() if x != "path")
+                entry["file"] = os.path.relpath(info["path"], os.path.join(stage, folder))
+                meta[folder][name] = entry
+        with open(os.path.join(stage, self.meta), "w") as f:
+            json.dump(meta, f, indent=2)
+        # Swap the new entry into place
+        target = os.path.join(self.path, key)
+        if os.path.exists(target):
+            shutil.rmtree(target, ignore_errors=True)
+        os.rename(stage, target)
+        self.evict(keep=key)
+        return self._expand(key, meta)
+
+    def entries(self):
+        # Returns a list of (key, meta) for every entry - least recently used first
+        if not os.path.exists(self.path):
+            return []
+        out = []
+        for key in os.listdir(self.path):
+            if not os.path.isdir(os.path.join(self.path, key)):
+                continue
+            meta = self._load_meta(key)
+            if meta is None:
+                # Partial or stale entry - give it a zero timestamp so it goes first
+                meta = {"last_used" : 0, "size" : self._folder_size(os.path.join(self.path, key))}
+            out.append((key, meta))
+        return sorted(out, key=lambda x: x[1].get("last_used", 0))
+
+    def evict(self, keep = None):
+        # Removes the least recently used entries until we're within budget
+        entries = self.entries()
+        total   = sum(x[1].get("size", 0) for x in entries)
+        removed = []
+        for key,meta in entries:
+            if total <= self.budget:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
+            total -= meta.get("size", 0)
+            removed.append(key)
+        return removed
+
+    def clear(self):
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path, ignore_errors=True)
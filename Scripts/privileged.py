@@ -0,0 +1,58 @@
+import sys, os
+sys.path.append(os.path.abspath(os.path.dirname(os.path.realpath(__file__))))
+import run
+
+# Copies each source to a temp file next to its target, then renames it over the
+# target - so every file is either the old one or the new one, never half of each.
+# Prints a tab separated status line per file.
+REPLACE_SCRIPT = '''
+while [ $# -gt 1 ]; do
+    src="$1"; dst="$2"; shift 2
+    tmp="$(dirname "$dst")/.$(basename "$dst").new"
+    if err="$(cp "$src" "$tmp" 2>&1 && mv -f "$tmp" "$dst" 2>&1)"; then
+        printf 'ok\\t%s\\n' "$dst"
+    else
+        rm -f "$tmp"
+        printf 'fail\\t%s\\t%s\\n' "$dst" "$(printf '%s' "$err" | tr '\\n' ' ')"
+    fi
+done
+'''
+
+class Privileged:
+
+    '''
+    Runs batches of file operations that need root in a single elevated
+    process - so there's one sudo (and at most one password prompt) no
+    matter how many files are involved.
+    '''
+
+    def __init__(self, **kwargs):
+        self.r    = kwargs.get("runner", None) or run.Run()
+        self.sudo = kwargs.get("sudo", True)
+
+    def replace(self, pairs):
+        # Replaces each target with its source - pairs is a list of (source, target) tuples.
+        # Returns a list of (target, error) tuples in the same order - error is None if it
+        # went through.
+        pairs = list(pairs)
+        if not pairs:
+            return []
+        args = ["/bin/sh", "-c", REPLACE_SCRIPT, "sh"]
+        for source,target in pairs:
+            args.extend([source, target])
+        out = self.r.run({"args":args, "sudo":self.sudo})
+        # The script reports on each pair in order
+        status = []
+        for line in out[0].split("\n"):
+            parts = line.split("\t")
+            if len(parts) >= 2 and parts[0] in ("ok", "fail"):
+                status.append((parts[1], None if parts[0] == "ok" else (parts[2].strip() if len(parts) > 2 else "Unknown error")))
+        # Anything without a status line never ran - likely sudo itself failing
+        error = out[1].strip() or "Failed to run as root"
+        results = []
+        for i,(source,target) in enumerate(pairs):
+            if i < len(status) and status[i][0] == target:
+                results.append(status[i])
+            else:
+                results.append((target, error))
+        return results
@@ -1,151 +1,322 @@
-import sys, subprocess, time, threading, shlex
-try:
-    from Queue import Queue, Empty
-except:
-    from queue import Queue, Empty
-
-ON_POSIX = 'posix' in sys.builtin_module_names
-
-class Run:
-
-    def __init__(self):
-        return
-
-    def _read_output(self, pipe, q):
-        try:
-            for line in iter(lambda: pipe.read(1), b''):
-                q.put(line)
-        except ValueError:
-            pass
-        pipe.close()
-
-    def _create_thread(self, output):
-        # Creates a new queue and thread object to watch based on the output pipe sent
-        q = Queue()
-        t = threading.Thread(target=self._read_output, args=(output, q))
-        t.daemon = True
-        return (q,t)
-
-    def _stream_output(self, comm, shell = False):
-        output = error = ""
-        p = None
-        try:
-            if shell and type(comm) is list:
-                comm = " ".join(shlex.quote(x) for x in comm)
-            if not shell and type(comm) is str:
-                comm = shlex.split(comm)
-            p = subprocess.Popen(comm, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0, universal_newlines=True, close_fds=ON_POSIX)
-            # Setup the stdout thread/queue
-            q,t   = self._create_thread(p.stdout)
-            qe,te = self._create_thread(p.stderr)
-            # Start both threads
-            t.start()
-            te.start()
-
-            while True:
-                c = z = ""
-                try: c = q.get_nowait()
-                except Empty: pass
-                else:
-                    sys.stdout.write(c)
-                    output += c
-                    sys.stdout.flush()
-                try: z = qe.get_nowait()
-                except Empty: pass
-                else:
-                    sys.stderr.write(z)
-                    error += z
-                    sys.stderr.flush()
-                if not c==z=="": continue # Keep going until empty
-                # No output - see if still running
-                p.poll()
-                if p.returncode != None:
-                    # Subprocess ended
-                    break
-                # No output, but subprocess still running - stall for 20ms
-                time.sleep(0.02)
-
-            o, e = p.communicate()
-            return (output+o, error+e, p.returncode)
-        except:
-            if p:
-                try: o, e = p.communicate()
-                except: o = e = ""
-                return (output+o, error+e, p.returncode)
-            return ("", "Command not found!", 1)
-
-    def _decode(self, value, encoding="utf-8", errors="ignore"):
-        # Helper method to only decode if bytes type
-        if sys.version_info >= (3,0) and isinstance(value, bytes):
-            return value.decode(encoding,errors)
-        return value
-
-    def _run_command(self, comm, shell = False):
-        c = None
-        try:
-            if shell and type(comm) is list:
-                comm = " ".join(shlex.quote(x) for x in comm)
-            if not shell and type(comm) is str:
-                comm = shlex.split(comm)
-            p = subprocess.Popen(comm, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            c = p.communicate()
-        except:
-            if c == None:
-                return ("", "Command not found!", 1)
-        return (self._decode(c[0]), self._decode(c[1]), p.returncode)
-
-    def run(self, command_list, leave_on_fail = False):
-        # Command list should be an array of dicts
-        if type(command_list) is dict:
-            # We only have one command
-            command_list = [command_list]
-        output_list = []
-        for comm in command_list:
-            args   = comm.get("args",   [])
-            shell  = comm.get("shell",  False)
-            stream = comm.get("stream", False)
-            sudo   = comm.get("sudo",   False)
-            stdout = comm.get("stdout", False)
-            stderr = comm.get("stderr", False)
-            mess   = comm.get("message", None)
-            show   = comm.get("show",   False)
-            
-            if not mess == None:
-                print(mess)
-
-            if not len(args):
-                # nothing to process
-                continue
-            if sudo:
-                # Check if we have sudo
-                out = self._run_command(["which", "sudo"])
-                if "sudo" in out[0]:
-                    # Can sudo
-                    if type(args) is list:
-                        args.insert(0, out[0].replace("\n", "")) # add to start of list
-                    elif type(args) is str:
-                        args = out[0].replace("\n", "") + " " + args # add to start of string
-            
-            if show:
-                print(" ".join(args))
-
-            if stream:
-                # Stream it!
-                out = self._stream_output(args, shell)
-            else:
-                # Just run and gather output
-                out = self._run_command(args, shell)
-                if stdout and len(out[0]):
-                    print(out[0])
-                if stderr and len(out[1]):
-                    print(out[1])
-            # Append output
-            output_list.append(out)
-            # Check for errors
-            if leave_on_fail and out[2] != 0:
-                # Got an error - leave
-                break
-        if len(output_list) == 1:
-            # We only ran one command - just return that output
-            return output_list[0]
-        return output_list
+import sys, os, io, subprocess, threading, shlex, codecs, time
+from contextlib import contextmanager
+try:
+    from Queue import Queue
+except:
+    from queue import Queue
+try:
+    import selectors
+except ImportError:
+    # Python 2 - we fall back on the reader threads
+    selectors = None
+
+ON_POSIX = 'posix' in sys.builtin_module_names
+
+# The scripts import this both as Scripts.run and as plain run (off the sys.path entries
+# they add) - make sure both copies share one cache and tracer
+_other  = sys.modules.get("Scripts.run" if __name__ == "run" else "run", None)
+_shared = getattr(_other, "_shared", None) or {
+    "cache" : {},
+    "cache_lock" : threading.Lock(),
+    "cache_stats" : {"hits" : 0, "misses" : 0},
+    "tracer" : None
+}
+
+def set_tracer(tracer):
+    # Pass a tracing.Tracer to record every command run from here on - or None to stop
+    _shared["tracer"] = tracer
+
+def get_tracer():
+    return _shared["tracer"]
+
+class Run:
+
+    # Results of read-only commands, shared by every Run - see the "cache" key in run()
+    cache       = _shared["cache"]
+    cache_lock  = _shared["cache_lock"]
+    cache_stats = _shared["cache_stats"]
+
+    def __init__(self):
+        self.chunk = 65536 # Bytes per read when streaming
+
+    def _read_output(self, pipe, q, tag = None):
+        try:
+            for chunk in iter(lambda: pipe.read(self.chunk), b''):
+                q.put((tag, chunk))
+        except ValueError:
+            pass
+        pipe.close()
+        # Let the main loop know this pipe is done
+        q.put((tag, None))
+
+    def _create_thread(self, output, q = None, tag = None):
+        # Creates a new queue (unless one is passed) and thread object to watch based on the output pipe sent
+        q = q or Queue()
+        t = threading.Thread(target=self._read_output, args=(output, q, tag))
+        t.daemon = True
+        return (q,t)
+
+    def _split_command(self, comm, shell = False):
+        if shell and type(comm) is list:
+            comm = " ".join(shlex.quote(x) for x in comm)
+        if not shell and type(comm) is str:
+            comm = shlex.split(comm)
+        return comm
+
+    def _get_decoder(self):
+        # Decodes streamed chunks without splitting multi-byte characters (or \r\n pairs)
+        # across reads, translating newlines as universal_newlines would - py2 keeps its
+        # str output as-is
+        if sys.version_info >= (3,0):
+            return io.IncrementalNewlineDecoder(codecs.getincrementaldecoder("utf-8")(errors="ignore"), True)
+        class Passthrough:
+            def decode(self, data, final = False):
+                return data
+        return Passthrough()
+
+    def _echo(self, stream, data):
+        # Writes the passed chunk out as it comes in
+        if not data:
+            return
+        stream.write(data)
+        stream.flush()
+
+    def _stream_selectors(self, handlers):
+        # Waits on both pipes and reads whatever is ready in large chunks - nothing polls,
+        # and nothing happens until one of them has data or closes
+        sel = selectors.DefaultSelector()
+        try:
+            for pipe,handler in handlers:
+                sel.register(pipe, selectors.EVENT_READ, (handler, self._get_decoder()))
+            while sel.get_map():
+                for key,_ in sel.select():
+                    handler,decoder = key.data
+                    data = os.read(key.fd, self.chunk)
+                    text = decoder.decode(data, final=not data)
+                    if text:
+                        handler(text)
+                    if not data:
+                        sel.unregister(key.fileobj)
+        finally:
+            sel.close()
+
+    def _stream_threads(self, handlers):
+        # Reader threads push chunks onto a shared queue - we block on it until both pipes close
+        q = Queue()
+        pipes = {}
+        for tag,(pipe,handler) in enumerate(handlers):
+            pipes[tag] = (handler, self._get_decoder())
+            self._create_thread(pipe, q, tag)[1].start()
+        while pipes:
+            tag,data = q.get()
+            handler,decoder = pipes[tag]
+            text = decoder.decode(data or b"", final=data is None)
+            if text:
+                handler(text)
+            if data is None:
+                del pipes[tag]
+
+    def _get_handler(self, stream, out, echo = None, capture = None):
+        # Returns a callable that takes each chunk of the passed stream - keeping it in out
+        # (or handing it to capture) and echoing it if needed
+        def handler(text):
+            if capture:
+                capture.feed(stream, text)
+            else:
+                out.append(text)
+            if echo:
+                self._echo(echo, text)
+        return handler
+
+    def _stream_output(self, comm, shell = False, echo = True, capture = None):
+        # Output is kept as a list of chunks and joined once at the end - or with a capture
+        # (see capture.py), only the tail it keeps is returned
+        output = []
+        error  = []
+        p = None
+        def result():
+            if capture:
+                capture.close()
+                return (capture.text("stdout"), capture.text("stderr"), p.returncode)
+            return ("".join(output), "".join(error), p.returncode)
+        try:
+            comm = self._split_command(comm, shell)
+            p = subprocess.Popen(comm, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0, close_fds=ON_POSIX)
+            handlers = (
+                (p.stdout, self._get_handler("stdout", output, sys.stdout if echo else None, capture)),
+                (p.stderr, self._get_handler("stderr", error,  sys.stderr if echo else None, capture))
+            )
+            if selectors:
+                self._stream_selectors(handlers)
+            else:
+                self._stream_threads(handlers)
+            p.wait()
+            return result()
+        except:
+            if p:
+                try: p.kill()
+                except: pass
+                try: p.wait()
+                except: pass
+                return result()
+            return ("", "Command not found!", 1)
+
+    def _decode(self, value, encoding="utf-8", errors="ignore"):
+        # Helper method to only decode if bytes type
+        if sys.version_info >= (3,0) and isinstance(value, bytes):
+            return value.decode(encoding,errors)
+        return value
+
+    def _run_command(self, comm, shell = False):
+        c = None
+        try:
+            comm = self._split_command(comm, shell)
+            p = subprocess.Popen(comm, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            c = p.communicate()
+        except:
+            if c == None:
+                return ("", "Command not found!", 1)
+        return (self._decode(c[0]), self._decode(c[1]), p.returncode)
+
+    def _cache_key(self, args, shell = False):
+        return (tuple(args) if type(args) is list else args, shell)
+
+    def _run_cached(self, args, shell = False, ttl = 0, group = None):
+        # Runs the command - or hands back what it gave us within the last ttl seconds.
+        # Returns (output, whether it came from the cache).
+        if not ttl:
+            return (self._run_command(args, shell), False)
+        out = self._cache_get(args, shell, ttl)
+        if out is not None:
+            return (out, True)
+        out = self._run_command(args, shell)
+        self._cache_put(args, shell, out, group)
+        return (out, False)
+
+    def _cache_get(self, args, shell, ttl):
+        # Returns the cached output if it's younger than ttl seconds - None otherwise
+        with Run.cache_lock:
+            entry = Run.cache.get(self._cache_key(args, shell), None)
+            if entry and time.time() - entry["time"] < ttl:
+                Run.cache_stats["hits"] += 1
+                return entry["out"]
+            Run.cache_stats["misses"] += 1
+        return None
+
+    def _cache_put(self, args, shell, out, group = None):
+        with Run.cache_lock:
+            Run.cache[self._cache_key(args, shell)] = {"time" : time.time(), "out" : out, "group" : group}
+
+    def invalidate(self, args = None, group = None, shell = False):
+        # Drops cached results - those of the passed args, and/or those in the passed
+        # group.  With neither, the whole cache is cleared.
+        with Run.cache_lock:
+            if args is None and group is None:
+                Run.cache.clear()
+                return
+            key = None if args is None else self._cache_key(args, shell)
+            for k in list(Run.cache):
+                if k == key or (group is not None and Run.cache[k]["group"] == group):
+                    Run.cache.pop(k, None)
+
+    def cache_summary(self):
+        # Returns a one line rundown of how many commands the cache has saved us
+        s = Run.cache_stats
+        total = s["hits"] + s["misses"]
+        return "Command cache: {} hit{}, {} miss{} ({:.0f}% saved)".format(
+            s["hits"],
+            "" if s["hits"] == 1 else "s",
+            s["misses"],
+            "" if s["misses"] == 1 else "es",
+            100.0 * s["hits"] / total if total else 0
+        )
+
+    @contextmanager
+    def span(self, name, **kwargs):
+        # Times the with block as one named step when tracing - does nothing otherwise
+        tracer = get_tracer()
+        if not tracer:
+            yield
+            return
+        with tracer.span(name, **kwargs):
+            yield
+
+    def _add_sudo(self, args):
+        # Check if we have sudo - it's not going anywhere, so we only look once an hour
+        start = time.time()
+        out,cached = self._run_cached(["which", "sudo"], ttl=3600)
+        if get_tracer():
+            get_tracer().command(["which", "sudo"], start, time.time(), out, cached=cached)
+        if "sudo" in out[0]:
+            # Can sudo
+            if type(args) is list:
+                args.insert(0, out[0].replace("\n", "")) # add to start of list
+            elif type(args) is str:
+                args = out[0].replace("\n", "") + " " + args # add to start of string
+        return args
+
+    def run(self, command_list, leave_on_fail = False):
+        # Command list should be an array of dicts.  Read-only commands can pass "cache"
+        # as a number of seconds to reuse their output for - and "cache_group" to allow
+        # invalidating related commands together.  Long-running commands can pass a
+        # capture.Capture as "capture" to keep their output in bounded memory.
+        if type(command_list) is dict:
+            # We only have one command
+            command_list = [command_list]
+        output_list = []
+        for comm in command_list:
+            args   = comm.get("args",   [])
+            shell  = comm.get("shell",  False)
+            stream = comm.get("stream", False)
+            sudo   = comm.get("sudo",   False)
+            stdout = comm.get("stdout", False)
+            stderr = comm.get("stderr", False)
+            mess   = comm.get("message", None)
+            show   = comm.get("show",   False)
+            ttl    = comm.get("cache",  0)
+            group  = comm.get("cache_group", None)
+            cap    = comm.get("capture", None)
+            
+            if not mess == None:
+                print(mess)
+
+            if not len(args):
+                # nothing to process
+                continue
+            if sudo:
+                args = self._add_sudo(args)
+            
+            if show:
+                print(" ".join(args))
+
+            start  = time.time()
+            cached = False
+            if stream:
+                # Stream it!
+                out = self._stream_output(args, shell, True, cap)
+            elif cap:
+                # Gather output a chunk at a time so the capture can keep it bounded
+                out = self._stream_output(args, shell, False, cap)
+                if stdout and len(out[0]):
+                    print(out[0])
+                if stderr and len(out[1]):
+                    print(out[1])
+            else:
+                # Just run and gather output
+                out,cached = self._run_cached(args, shell, ttl, group)
+                if stdout and len(out[0]):
+                    print(out[0])
+                if stderr and len(out[1]):
+                    print(out[1])
+            if get_tracer():
+                get_tracer().command(args, start, time.time(), out, cached=cached, stream=stream, sudo=sudo, capture=cap)
+            # Append output
+            output_list.append(out)
+            # Check for errors
+            if leave_on_fail and out[2] != 0:
+                # Got an error - leave
+                break
+        if len(output_list) == 1:
+            # We only ran one command - just return that output
+            return output_list[0]
+        return output_list
@@ -0,0 +1,143 @@
+import sys, os, asyncio, codecs, io, time
+sys.path.append(os.path.abspath(os.path.dirname(os.path.realpath(__file__))))
+import run
+
+class AsyncRun(run.Run):
+
+    '''
+    An asyncio take on Run - same command dicts, same (stdout, stderr,
+    returncode) tuples - so independent commands can be overlapped rather
+    than waited on one at a time.  Needs python 3.5 or newer.
+    '''
+
+    def __init__(self, **kwargs):
+        run.Run.__init__(self)
+        self.limit = kwargs.get("limit", 4) # Most commands gather() runs at once
+
+    async def _read_stream(self, stream, handler, callback):
+        # Reads the pipe a chunk at a time - keeping, echoing and/or handing each decoded chunk off
+        decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder("utf-8")(errors="ignore"), True)
+        while True:
+            data = await stream.read(self.chunk)
+            text = decoder.decode(data, final=not data)
+            if text:
+                handler(text)
+                if callback:
+                    callback(text)
+            if not data:
+                break
+
+    async def _run_async_command(self, comm, shell = False, stream = False, on_stdout = None, on_stderr = None, capture = None):
+        output = []
+        error  = []
+        p = None
+        def result():
+            if capture:
+                capture.close()
+                return (capture.text("stdout"), capture.text("stderr"), p.returncode)
+            return ("".join(output), "".join(error), p.returncode)
+        try:
+            comm = self._split_command(comm, shell)
+            if shell:
+                p = await asyncio.create_subprocess_shell(comm, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            else:
+                p = await asyncio.create_subprocess_exec(*comm, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            await asyncio.gather(
+                self._read_stream(p.stdout, self._get_handler("stdout", output, sys.stdout if stream else None, capture), on_stdout),
+                self._read_stream(p.stderr, self._get_handler("stderr", error,  sys.stderr if stream else None, capture), on_stderr)
+            )
+            await p.wait()
+            return result()
+        except asyncio.CancelledError:
+            if p and p.returncode is None:
+                try: p.kill()
+                except: pass
+            raise
+        except:
+            if p:
+                try: p.kill()
+                except: pass
+                try: await p.wait()
+                except: pass
+                return result()
+            return ("", "Command not found!", 1)
+
+    async def run_async(self, command_list, leave_on_fail = False):
+        # Same as run() - command list can be a dict or a list of dicts run in order, and
+        # "cache", "cache_group" and "capture" work the same way.  Dicts also take on_stdout and on_stderr callbacks,
+        # which get each chunk of output as it comes in.
+        if type(command_list) is dict:
+            # We only have one command
+            command_list = [command_list]
+        output_list = []
+        for comm in command_list:
+            args   = comm.get("args",   [])
+            shell  = comm.get("shell",  False)
+            stream = comm.get("stream", False)
+            sudo   = comm.get("sudo",   False)
+            stdout = comm.get("stdout", False)
+            stderr = comm.get("stderr", False)
+            mess   = comm.get("message", None)
+            show   = comm.get("show",   False)
+
+            if not mess == None:
+                print(mess)
+
+            if not len(args):
+                # nothing to process
+                continue
+            if sudo:
+                args = self._add_sudo(list(args) if type(args) is list else args)
+
+            if show:
+                print(" ".join(args))
+
+            start  = time.time()
+            cap    = comm.get("capture", None)
+            ttl    = comm.get("cache", 0) if not (stream or cap) else 0
+            cached = False
+            out = self._cache_get(args, shell, ttl) if ttl else None
+            if out is not None:
+                cached = True
+                # Nothing ran - but the callbacks still get the output
+                for text,callback in ((out[0], comm.get("on_stdout", None)), (out[1], comm.get("on_stderr", None))):
+                    if text and callback:
+                        callback(text)
+            else:
+                out = await self._run_async_command(args, shell, stream, comm.get("on_stdout", None), comm.get("on_stderr", None), cap)
+                if ttl:
+                    self._cache_put(args, shell, out, comm.get("cache_group", None))
+            if run.get_tracer():
+                run.get_tracer().command(args, start, time.time(), out, cached=cached, stream=stream, sudo=sudo, capture=cap)
+            if not stream:
+                if stdout and len(out[0]):
+                    print(out[0])
+                if stderr and len(out[1]):
+                    print(out[1])
+            # Append output
+            output_list.append(out)
+            # Check for errors
+            if leave_on_fail and out[2] != 0:
+                # Got an error - leave
+                break
+        if len(output_list) == 1:
+            # We only ran one command - just return that output
+            return output_list[0]
+        return output_list
+
+    async def gather(self, command_lists, leave_on_fail = False, limit = None):
+        # Runs each entry of command_lists - each what you'd pass to run_async() - alongside
+        # the others, no more than limit at once.  Returns their outputs in the same order.
+        sem = asyncio.Semaphore(max(1, limit or self.limit))
+        async def _run(command_list):
+            async with sem:
+                return await self.run_async(command_list, leave_on_fail)
+        return await asyncio.gather(*[_run(x) for x in command_lists])
+
+    def run_many(self, command_lists, leave_on_fail = False, limit = None):
+        # Blocking wrapper around gather() for callers that aren't async themselves
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.gather(command_lists, leave_on_fail, limit))
+        finally:
+            loop.close()
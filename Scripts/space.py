@@ -0,0 +1,47 @@
+import os
+
+def get_free(path):
+    # Returns (bytes free to us, allocation block size) for the volume holding path
+    st = os.statvfs(path)
+    return (st.f_bavail * st.f_frsize, st.f_frsize or 512)
+
+def round_up(size, block):
+    # Files take up whole clusters - FAT32 ESPs commonly use 4 KiB or more
+    if not size or block <= 1:
+        return size
+    return (size + block - 1) // block * block
+
+def get_usage(path, block = 1):
+    # Returns a list of (name, bytes, files) for each folder directly within path - plus
+    # the files at its top level as "." - sorted largest first
+    usage = []
+    top = [0, 0]
+    for name in sorted(os.listdir(path)):
+        full = os.path.join(path, name)
+        if os.path.isdir(full):
+            size = files = 0
+            for root,dirs,fs in os.walk(full):
+                for f in fs:
+                    try:
+                        size += round_up(os.path.getsize(os.path.join(root,f)), block)
+                        files += 1
+                    except OSError:
+                        pass
+            usage.append((name, size, files))
+        elif os.path.isfile(full):
+            top[0] += round_up(os.path.getsize(full), block)
+            top[1] += 1
+    if top[1]:
+        usage.append((".", top[0], top[1]))
+    return sorted(usage, key=lambda x: x[1], reverse=True)
+
+def format_usage(root):
+    # Returns the lines of a usage report for the EFI/CLOVER folder on the volume at root
+    c_path = os.path.join(root, "EFI", "CLOVER")
+    if not os.path.isdir(c_path):
+        return ["No EFI/CLOVER folder at {}.".format(root)]
+    free,block = get_free(root)
+    lines = ["EFI/CLOVER usage ({:,} bytes free):".format(free)]
+    for name,size,files in get_usage(c_path, block):
+        lines.append(" {:>12} {:>5} file{} {}".format("{:,}".format(size), files, " " if files == 1 else "s", name))
+    return lines
@@ -0,0 +1,123 @@
+import sys, os, json, time, threading
+from contextlib import contextmanager
+
+class Tracer:
+
+    '''
+    Records what every command run through Run costs - argv, when it
+    started and ended, how much it printed, how it exited, and where it
+    was called from - along with named spans around larger steps.  Saves
+    as JSON Lines, or as Chrome trace events for chrome://tracing and
+    Perfetto.
+    '''
+
+    def __init__(self, **kwargs):
+        # Frames from these files are skipped when looking for the caller
+        self.skip    = kwargs.get("skip", ["run.py", "runasync.py", "tracing.py", "contextlib.py"])
+        self.records = []
+        self.lock    = threading.Lock()
+        self.start   = time.time()
+        self.pid     = os.getpid()
+
+    def _size(self, value):
+        # Bytes in the passed output - it's text by the time we see it
+        if not value:
+            return 0
+        if sys.version_info >= (3,0) or isinstance(value, unicode):
+            return len(value.encode("utf-8", "ignore"))
+        return len(value)
+
+    def get_caller(self):
+        # Returns "file:line (function)" for the first frame outside of the runner
+        try:
+            f = sys._getframe(1)
+        except (AttributeError, ValueError):
+            return None
+        while f:
+            name = os.path.basename(f.f_code.co_filename)
+            if not name in self.skip and not "asyncio" in f.f_code.co_filename:
+                return "{}:{} ({})".format(name, f.f_lineno, f.f_code.co_name)
+            f = f.f_back
+        return None
+
+    def add(self, record):
+        record["thread"] = threading.current_thread().ident
+        with self.lock:
+            self.records.append(record)
+        return record
+
+    def command(self, args, start, end, out, **kwargs):
+        # Records a single finished command - out being its (stdout, stderr, returncode).
+        # With a capture, out only has the tail - so we take its totals instead.
+        capture = kwargs.get("capture", None)
+        return self.add({
+            "type" : "command",
+            "args" : list(args) if type(args) in (list, tuple) else [args],
+            "start" : start,
+            "end" : end,
+            "seconds" : end - start,
+            "stdout_bytes" : capture.size("stdout") if capture else self._size(out[0]),
+            "stderr_bytes" : capture.size("stderr") if capture else self._size(out[1]),
+            "returncode" : out[2],
+            "caller" : kwargs.get("caller", None) or self.get_caller(),
+            "cached" : kwargs.get("cached", False),
+            "stream" : kwargs.get("stream", False),
+            "sudo" : kwargs.get("sudo", False)
+        })
+
+    @contextmanager
+    def span(self, name, **kwargs):
+        # Times everything within the with block as one named step
+        caller = self.get_caller()
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            self.add({"type" : "span", "name" : name, "start" : start, "end" : end, "seconds" : end - start, "caller" : caller, "args" : kwargs})
+
+    def summary(self):
+        # Returns a one line rundown of the commands recorded so far
+        commands = [x for x in self.records if x["type"] == "command"]
+        return "Traced {} command{} - {:.2f}s in subprocesses, {:,} bytes of output".format(
+            len(commands),
+            "" if len(commands) == 1 else "s",
+            sum(x["seconds"] for x in commands),
+            sum(x["stdout_bytes"] + x["stderr_bytes"] for x in commands)
+        )
+
+    def export_jsonl(self, path):
+        # One JSON object per line, in the order they finished
+        with open(path, "w") as f:
+            for r in sorted(self.records, key=lambda x: x["end"]):
+                f.write(json.dumps(r) + "\n")
+
+    def export_chrome(self, path):
+        # Complete ("X") events in microseconds from when we started tracing
+        events = []
+        for r in sorted(self.records, key=lambda x: x["start"]):
+            if r["type"] == "command":
+                name = os.path.basename(str(r["args"][0])) if r["args"] else "?"
+                args = dict((x,y) for x,y in r.items() if not x in ("type", "start", "end", "thread"))
+            else:
+                name = r["name"]
+                args = dict(r["args"], caller=r["caller"])
+            events.append({
+                "name" : name,
+                "cat" : r["type"],
+                "ph" : "X",
+                "ts" : int((r["start"] - self.start) * 1000000),
+                "dur" : int((r["end"] - r["start"]) * 1000000),
+                "pid" : self.pid,
+                "tid" : r["thread"],
+                "args" : args
+            })
+        with open(path, "w") as f:
+            json.dump({"traceEvents" : events, "displayTimeUnit" : "ms"}, f)
+
+    def export(self, path):
+        # Chrome trace events for .json - JSON Lines for anything else
+        if path.lower().endswith(".json"):
+            self.export_chrome(path)
+        else:
+            self.export_jsonl(path)
@@ -0,0 +1,232 @@
+import sys, os, json, time
+
+class Transaction:
+
+    '''
+    Stages a batch of file changes on a volume and applies them together.
+    New files are written next to their targets under hidden temp names,
+    and a journal at the volume root records every operation.  Commit swaps
+    everything into place with renames - keeping the old files as hidden
+    backups until the end - so a failure at any point can be rolled back,
+    either right away or by recover() the next time the volume is seen.
+    '''
+
+    def __init__(self, root, **kwargs):
+        self.root    = root
+        self.journal = os.path.join(root, kwargs.get("journal", ".CloverExtractor.journal"))
+        self.ops     = []
+        self.state   = "staging"
+        self.paths   = ("target", "source", "staged", "backup")
+
+    def _hidden(self, path, suffix):
+        # Dot-prefixed so driver listings and the firmware's boot scan ignore it
+        return os.path.join(os.path.dirname(path), ".{}.{}".format(os.path.basename(path), suffix))
+
+    def _sync(self):
+        # Flush what we've written before a rename can make it live
+        if hasattr(os, "sync"):
+            os.sync()
+
+    def _write_journal(self):
+        # Write then rename so a crash never leaves a half written journal
+        data = {
+            "state" : self.state,
+            "updated" : time.time(),
+            "ops" : [dict((x, os.path.relpath(y, self.root) if y and x in self.paths else y) for x,y in op.items()) for op in self.ops]
+        }
+        with open(self.journal + ".tmp", "w") as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(self.journal + ".tmp", self.journal)
+
+    def _remove(self, path):
+        if path and os.path.exists(path):
+            os.remove(path)
+
+    def _add(self, target, source):
+        if any(x for x in self.ops if x["target"] == target):
+            raise ValueError("{} is already part of this transaction".format(os.path.basename(target)))
+        op = {
+            "target" : target,
+            "source" : source,
+            "staged" : source if source == self._hidden(target, "new") else None,
+            "backup" : self._hidden(target, "old")
+        }
+        # Nothing's been applied yet - so any backup lying around is stale
+        self._remove(op["backup"])
+        self.ops.append(op)
+        self._write_journal()
+        return op
+
+    def reserve(self, target):
+        # Returns a temp path next to target to write the new file to - whatever's there
+        # on commit replaces target
+        if self.state != "staging":
+            raise ValueError("Transaction already {}".format(self.state))
+        op = self._add(target, self._hidden(target, "new"))
+        self._remove(op["staged"])
+        return op["staged"]
+
+    def stage(self, target, writer):
+        # Calls writer with the reserved temp path for target - returns whatever writer returns
+        return writer(self.reserve(target))
+
+    def move(self, source, target):
+        # Renames source to target on commit - replacing target if it exists
+        if self.state != "staging":
+            raise ValueError("Transaction already {}".format(self.state))
+        self._add(target, source)
+
+    def move_now(self, source, target):
+        # Renames source to target right away - files or folders - but keeps it in the
+        # journal so a rollback still puts it back.  Target must not exist.
+        if self.state != "staging":
+            raise ValueError("Transaction already {}".format(self.state))
+        if os.path.exists(target):
+            raise ValueError("{} already exists".format(os.path.basename(target)))
+        op = self._add(target, source)
+        op["applied"] = True
+        self._write_journal()
+        os.rename(source, target)
+
+    def mkdir_now(self, path):
+        # Creates path and any missing parents right away - each journaled so a rollback
+        # takes back out whatever we made
+        if self.state != "staging":
+            raise ValueError("Transaction already {}".format(self.state))
+        missing = []
+        while path and not os.path.exists(path):
+            missing.insert(0, path)
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+        for folder in missing:
+            op = self._add(folder, None)
+            op["applied"] = True
+            op["folder"]  = True
+            self._write_journal()
+            os.mkdir(folder)
+
+    def remove(self, target):
+        # Removes target on commit
+        if self.state != "staging":
+            raise ValueError("Transaction already {}".format(self.state))
+        self._add(target, None)
+
+    def _apply(self, op):
+        if op.get("folder"):
+            # Made when it was added
+            return
+        self._remove(op["backup"])
+        if os.path.exists(op["target"]):
+            os.rename(op["target"], op["backup"])
+        if op["source"]:
+            os.rename(op["source"], op["target"])
+
+    def _undo(self, op):
+        # Puts things back the way they were - safe to call on ops that were never,
+        # or only partly applied.  Only an applied op can have put its source on target -
+        # a missing source on any other op (a staged file that never got written) says
+        # nothing about whose target that is.
+        if op.get("folder"):
+            # Only if we emptied it back out - anything else in there isn't ours to remove
+            if os.path.isdir(op["target"]) and not os.listdir(op["target"]):
+                os.rmdir(op["target"])
+            return
+        if op.get("applied") and op["source"] and not os.path.exists(op["source"]) and os.path.exists(op["target"]):
+            os.rename(op["target"], op["source"])
+        if os.path.exists(op["backup"]):
+            self._remove(op["target"])
+            os.rename(op["backup"], op["target"])
+        self._remove(op["staged"])
+
+    def _finish(self):
+        for op in self.ops:
+            try:
+                self._remove(op["backup"])
+            except OSError:
+                pass
+        self._remove(self.journal)
+
+    def commit(self):
+        # Applies every staged op - rolls back and re-raises if any of them fail
+        if self.state != "staging":
+            raise ValueError("Transaction already {}".format(self.state))
+        if not self.ops:
+            self.state = "committed"
+            return
+        self._sync()
+        self.state = "committing"
+        self._write_journal()
+        try:
+            for op in self.ops:
+                if not op.get("applied"):
+                    # Journaled before we touch anything so recover() knows it may have
+                    # gone through
+                    op["applied"] = True
+                    self._write_journal()
+                    self._apply(op)
+        except Exception as e:
+            errors = self.rollback()
+            if errors:
+                raise OSError("{} - and failed to roll back {}".format(e, ", ".join(errors)))
+            raise
+        self.state = "committed"
+        self._write_journal()
+        self._sync()
+        self._finish()
+
+    def rollback(self):
+        # Undoes whatever was applied in reverse order and drops the staged files.
+        # Returns a list of errors for anything we couldn't put back.
+        errors = []
+        for op in reversed(self.ops):
+            try:
+                self._undo(op)
+            except Exception as e:
+                errors.append("{}: {}".format(os.path.basename(op["target"]), e))
+        self.state = "rolled back"
+        if not errors:
+            self._remove(self.journal)
+        self._sync()
+        return errors
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Commits if the block finished cleanly - rolls back otherwise
+        if self.state != "staging":
+            return False
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+def recover(root, journal = ".CloverExtractor.journal"):
+    # Finishes or rolls back a transaction interrupted on the volume at root.  Returns
+    # None if there was nothing to do, otherwise the state the journal was left in.
+    path = os.path.join(root, journal)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except Exception:
+        # The journal is only ever swapped in whole - a bad one has nothing we can use
+        os.remove(path)
+        return None
+    t = Transaction(root, journal=journal)
+    t.state = data.get("state", "staging")
+    t.ops = [dict((x, os.path.join(root, y) if y and x in t.paths else y) for x,y in op.items()) for op in data.get("ops", [])]
+    if t.state == "committed":
+        # Everything landed - just the backups left to clean up
+        t._finish()
+        return "committed"
+    errors = t.rollback()
+    if errors:
+        raise OSError("Failed to roll back: {}".format(", ".join(errors)))
+    return data.get("state", "staging")
@@ -0,0 +1,67 @@
+import sys, os, time, hashlib
+from multiprocessing.pool import ThreadPool
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+F_NOCACHE = 48 # macOS - read from the disk instead of the buffer cache
+
+class Verifier:
+
+    '''
+    Re-reads installed files and checks them against the hashes we took at
+    extraction.  Files are streamed a chunk at a time across a small thread
+    pool, and on macOS the reads skip the buffer cache so we see what
+    actually made it to the disk rather than what we just wrote.
+    '''
+
+    def __init__(self, **kwargs):
+        self.workers   = kwargs.get("workers", 4)
+        self.chunk     = kwargs.get("chunk", 1048576)
+        self.algorithm = kwargs.get("algorithm", "sha256")
+
+    def hash_file(self, path):
+        h = hashlib.new(self.algorithm)
+        with open(path, "rb") as f:
+            if fcntl and sys.platform == "darwin":
+                try:
+                    fcntl.fcntl(f.fileno(), F_NOCACHE, 1)
+                except Exception:
+                    pass
+            while True:
+                data = f.read(self.chunk)
+                if not data:
+                    break
+                h.update(data)
+        return h.hexdigest()
+
+    def _check(self, item):
+        path,expected = item
+        out = {"path" : path, "expected" : expected, "actual" : None, "size" : 0, "error" : None}
+        try:
+            out["size"]   = os.path.getsize(path)
+            out["actual"] = self.hash_file(path)
+        except Exception as e:
+            out["error"] = str(e)
+        out["ok"] = out["actual"] is not None and out["actual"] == expected
+        return out
+
+    def verify(self, items):
+        # Takes a list of (path, expected hash) tuples and returns (results, seconds) - each
+        # result a dict with path, expected, actual, size, error, and ok
+        items = list(items)
+        if not items:
+            return ([], 0)
+        start = time.time()
+        workers = max(1, min(self.workers, len(items)))
+        if workers == 1:
+            results = [self._check(x) for x in items]
+        else:
+            pool = ThreadPool(workers)
+            try:
+                results = pool.map(self._check, items)
+            finally:
+                pool.close()
+                pool.join()
+        return (results, time.time() - start)
@@ -0,0 +1,177 @@
+import sys, os, struct, zlib, bz2
+import xml.etree.ElementTree as ET
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+class XarStream:
+
+    '''
+    File-like reader over a single xar heap entry - decodes on the fly
+    so the archived data never needs to hit the disk.
+    '''
+
+    def __init__(self, path, offset, length, encoding, chunk = 1048576):
+        self.f         = open(path, "rb")
+        self.f.seek(offset)
+        self.remaining = length
+        self.chunk     = chunk
+        self.buffer    = b""
+        self.pos       = 0
+        self.eof       = False
+        self.decoder   = None
+        encoding = (encoding or "").lower()
+        if encoding in ("application/x-gzip","application/zlib"):
+            # xar's "gzip" is actually a zlib stream
+            self.decoder = zlib.decompressobj()
+        elif encoding == "application/x-bzip2":
+            self.decoder = bz2.BZ2Decompressor()
+        elif encoding in ("application/x-lzma","application/x-xz"):
+            if lzma is None:
+                self.close()
+                raise ValueError("lzma support is not available")
+            self.decoder = lzma.LZMADecompressor()
+        elif encoding not in ("","application/octet-stream"):
+            self.close()
+            raise ValueError("Unsupported xar encoding: {}".format(encoding))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.f:
+            self.f.close()
+            self.f = None
+
+    def _fill(self):
+        # Reads and decodes the next chunk from the heap - returns False when exhausted
+        if self.eof:
+            return False
+        if self.remaining <= 0:
+            self.eof = True
+            if self.decoder and hasattr(self.decoder, "flush"):
+                self._append(self.decoder.flush())
+            return False
+        data = self.f.read(min(self.chunk, self.remaining))
+        if not data:
+            raise ValueError("Unexpected end of xar heap")
+        self.remaining -= len(data)
+        if self.decoder:
+            data = self.decoder.decompress(data)
+        self._append(data)
+        return True
+
+    def _append(self, data):
+        # Drop what we've already handed out before growing the buffer
+        if self.pos:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        self.buffer += data
+
+    def read(self, size = -1):
+        if size is None or size < 0:
+            while self._fill():
+                pass
+            size = len(self.buffer) - self.pos
+        else:
+            while len(self.buffer) - self.pos < size and self._fill():
+                pass
+        data = self.buffer[self.pos:self.pos+size]
+        self.pos += len(data)
+        return data
+
+class Xar:
+
+    '''
+    Minimal xar (flat package) reader.  Parses the zlib compressed TOC and
+    exposes each entry's location in the heap so callers can stream only
+    the data they're after.
+    '''
+
+    def __init__(self, path):
+        self.path   = path
+        self.header = {}
+        self.files  = []
+        self._parse()
+
+    def _parse(self):
+        with open(self.path, "rb") as f:
+            head = f.read(28)
+            if len(head) < 28 or head[:4] != b"xar!":
+                raise ValueError("{} is not a xar archive".format(os.path.basename(self.path)))
+            magic, h_size, version, toc_comp, toc_size, cksum = struct.unpack(">4sHHQQI", head)
+            self.header = {
+                "header_size" : h_size,
+                "version" : version,
+                "toc_length_compressed" : toc_comp,
+                "toc_length_uncompressed" : toc_size,
+                "checksum_alg" : cksum
+            }
+            f.seek(h_size)
+            toc = zlib.decompress(f.read(toc_comp))
+        self.heap_start = h_size + toc_comp
+        root = ET.fromstring(toc).find("toc")
+        if root is None:
+            raise ValueError("Malformed xar TOC")
+        self._walk(root, "")
+
+    def _walk(self, node, parent):
+        for f in node.findall("file"):
+            name = f.findtext("name", "")
+            path = name if not parent else parent + "/" + name
+            entry = {
+                "path" : path,
+                "name" : name,
+                "type" : f.findtext("type", "file"),
+                "offset" : None,
+                "length" : 0,
+                "size" : 0,
+                "encoding" : None
+            }
+            data = f.find("data")
+            if data is not None:
+                enc = data.find("encoding")
+                entry["offset"]   = int(data.findtext("offset", "0"))
+                entry["length"]   = int(data.findtext("length", "0"))
+                entry["size"]     = int(data.findtext("size", "0"))
+                entry["encoding"] = enc.get("style") if enc is not None else None
+            self.files.append(entry)
+            self._walk(f, path)
+
+    def get_file(self, path):
+        # Returns the entry matching the passed path - case-insensitive
+        path = path.strip("/").lower()
+        return next((x for x in self.files if x["path"].lower() == path), None)
+
+    def list_dir(self, path = ""):
+        # Returns the names of the direct children of the passed path
+        path = path.strip("/").lower()
+        out = []
+        for x in self.files:
+            parent,_,name = x["path"].rpartition("/")
+            if parent.lower() == path:
+                out.append(name)
+        return out
+
+    def open(self, entry, chunk = 1048576):
+        # Returns a file-like object that streams the decoded entry data
+        if isinstance(entry, str):
+            entry = self.get_file(entry)
+        if not entry or entry["offset"] is None:
+            raise ValueError("No data for xar entry")
+        return XarStream(self.path, self.heap_start + entry["offset"], entry["length"], entry["encoding"], chunk)
+
+    def extract_file(self, entry, target, chunk = 1048576):
+        # Streams the passed entry to the target path
+        with self.open(entry, chunk) as s:
+            with open(target, "wb") as f:
+                while True:
+                    data = s.read(chunk)
+                    if not data:
+                        break
+                    f.write(data)
+        return target